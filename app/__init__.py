@@ -1,8 +1,9 @@
 from flask import Flask
 from .config import Config
-from flask_mysqldb import MySQL
 import sqlalchemy
-from app.database.main import create_database
+from app.database.main import create_database, seed_database, Session
+from app.database.message_queue import message_queue
+from app.housingApi.main import create_house_database, Session as HouseSession
 import datetime
 
 def create_app():
@@ -11,8 +12,25 @@ def create_app():
     app.jinja_env.filters['format_time'] = format_time
     app.jinja_env.filters['format_date'] = format_date
 
-    # database setup
+    # database setup, done once here rather than on every request
     create_database()
+    create_house_database()
+    if app.config['MESSAGE_QUEUE_ENABLED']:
+        # writes out messages journalled before a restart
+        message_queue.start()
+
+    @app.cli.command('init-db')
+    def init_db():
+        """Creates the database tables and adds the seed users."""
+        create_database()
+        create_house_database()
+        created = seed_database()
+        print(f"Databases ready, added seed users: {', '.join(created) or 'none'}")
+
+    @app.teardown_appcontext
+    def remove_sessions(exception=None):
+        Session.remove()
+        HouseSession.remove()
 
     # Add the routes
     from .routes import main
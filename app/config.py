@@ -5,3 +5,88 @@ from bcrypt import gensalt
 
 class Config:
     SECRET_KEY = gensalt().decode('utf8')
+
+    USERS_DATABASE_URL = 'sqlite:///app/database/database.db'
+    HOUSES_DATABASE_URL = 'sqlite:///app/housingApi/houses_database.db'
+
+    # connection pool shared by every request to a database
+    DATABASE_POOL_SIZE = 5
+    DATABASE_MAX_OVERFLOW = 10
+    DATABASE_POOL_TIMEOUT = 30
+    # both databases are opened in WAL mode, see app/storage.py; seconds a
+    # connection waits for another's write lock before giving up
+    SQLITE_BUSY_TIMEOUT = 5
+    # page cache of each connection, and how much of the file it may map
+    SQLITE_CACHE_SIZE_KIB = 64 * 1024
+    SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+
+    # serve property searches from an in-memory copy of the houses table;
+    # the map's spatial index is built from that copy either way
+    HOUSE_CATALOG_ENABLED = False
+    # seconds between checks of whether the houses table has changed
+    HOUSE_CATALOG_REFRESH_INTERVAL = 2
+    # largest radius in km the map's "houses near" search accepts
+    MAP_MAX_RADIUS_KM = 50
+
+    # seconds browsers may cache house images for, their urls change with
+    # their content
+    HOUSE_IMAGE_MAX_AGE = 365 * 24 * 60 * 60
+
+    # Nominatim allows one request per second and asks for an identifying
+    # User-Agent
+    GEOCODER_URL = 'https://nominatim.openstreetmap.org/search'
+    GEOCODER_USER_AGENT = 'first-year-project/1.0 (house search)'
+    GEOCODER_REQUESTS_PER_SECOND = 1
+    # seconds a geocoded place is reused for before it is looked up again,
+    # places that were not found are retried sooner
+    GEOCODE_CACHE_TTL = 30 * 24 * 60 * 60
+    GEOCODE_NOT_FOUND_TTL = 24 * 60 * 60
+    # seconds before a postcode postcodes.io didn't know is asked about again
+    POSTCODE_NOT_FOUND_TTL = 7 * 24 * 60 * 60
+
+    # seconds after its last scrape a listing is taken out of searches
+    LISTING_DELIST_AFTER = 3 * 24 * 60 * 60
+
+    # seconds a login lasts
+    SESSION_LIFETIME = 14 * 24 * 60 * 60
+    # session id -> user id cache of each process, entries are rechecked
+    # against the database after SESSION_CACHE_TTL seconds
+    SESSION_CACHE_SIZE = 10000
+    SESSION_CACHE_TTL = 60
+    # user id -> ids of their chats, likewise rechecked after
+    # MEMBERSHIP_CACHE_TTL seconds for changes made by other processes
+    MEMBERSHIP_CACHE_SIZE = 10000
+    MEMBERSHIP_CACHE_TTL = 60
+
+    # bcrypt cost of new password hashes, each step doubles the time taken
+    PASSWORD_HASH_ROUNDS = 12
+    # threads hashing passwords, and how many more hashes may wait for one
+    # (for up to PASSWORD_HASH_WAIT seconds) before logins are turned away
+    PASSWORD_HASH_WORKERS = 4
+    PASSWORD_HASH_MAX_PENDING = 32
+    PASSWORD_HASH_WAIT = 5
+
+    # seconds between keep-alive comments on an idle chat event stream, and
+    # after which a stream is closed for the browser to reconnect
+    CHAT_STREAM_HEARTBEAT = 15
+    CHAT_STREAM_MAX_AGE = 300
+
+    # answer chat messages once journalled and commit them in batches from
+    # a single writer thread, see app/database/message_queue.py
+    MESSAGE_QUEUE_ENABLED = False
+    MESSAGE_QUEUE_JOURNAL = 'app/database/message_journal.jsonl'
+    # journals to choose from, one is needed for each worker process
+    MESSAGE_QUEUE_JOURNAL_SLOTS = 16
+    # most messages a commit, and seconds the first of them waits for more
+    MESSAGE_QUEUE_BATCH_SIZE = 100
+    MESSAGE_QUEUE_FLUSH_INTERVAL = 0.05
+    # messages waiting to be written before senders are turned away
+    MESSAGE_QUEUE_MAX_PENDING = 10000
+    # fsync the journal for every message, to survive power loss and not
+    # only the process dying
+    MESSAGE_QUEUE_FSYNC = False
+
+    # messages loaded when a chat is opened and per "load older" click,
+    # and the most a client may ask for at once
+    CHAT_HISTORY_PAGE_SIZE = 50
+    CHAT_HISTORY_MAX_PAGE_SIZE = 500
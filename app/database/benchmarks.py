@@ -0,0 +1,468 @@
+"""
+Benchmarks for the users database, each run against a fresh database in a
+temporary directory so the real one is left alone.
+
+Run with: python -m app.database.benchmarks [name ...]
+"""
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event, insert, text
+
+from app.config import Config
+from app.storage import sqlite_engines
+from app.database import main
+from app.database.main import Base, DatabaseRequests, SEED_USERS, Session, User, \
+    Sessions, ChatMessage, create_database, seed_database, session_cache
+
+
+def use_temporary_database(directory):
+    """Points Session at a new database in directory, returns its writer engine."""
+    engine, read_engine = sqlite_engines(f"sqlite:///{os.path.join(directory, 'benchmark.db')}")
+    Session.remove()
+    Session.configure(writer=engine, reader=read_engine)
+    create_database(engine)
+    return engine
+
+
+def time_calls(function, repeats):
+    """Microseconds taken by each of `repeats` calls of function."""
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def report(name, timings):
+    timings = sorted(timings)
+    p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+    print(f"{name:<28}{statistics.median(timings):>10.0f}{statistics.mean(timings):>10.0f}"
+          f"{p99:>10.0f}")
+
+
+def benchmark_requests(repeats=2000):
+    """Cost of setting up DatabaseRequests for one logged in request."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = use_temporary_database(directory)
+        seed_database()
+        session_id = DatabaseRequests().login(*SEED_USERS[0])
+
+        def before():
+            # what DatabaseRequests.__init__ used to do on every request
+            Base.metadata.create_all(engine)
+            session = Session()
+            for username, _ in SEED_USERS:
+                session.query(User).filter_by(username=username).first()
+            session.query(Sessions).filter(Sessions.sessionID == session_id).first()
+            Session.remove()
+
+        def after():
+            assert DatabaseRequests(session_id).user_id is not None
+            Session.remove()
+
+        print(f"{'per request setup (µs)':<28}{'median':>10}{'mean':>10}{'p99':>10}")
+        report("before", time_calls(before, repeats))
+        report("after", time_calls(after, repeats))
+        Session.remove()
+
+
+def benchmark_sessions(session_count=50000, repeats=2000):
+    """Cost of resolving a session id to its user, among session_count sessions."""
+    with tempfile.TemporaryDirectory() as directory:
+        engine = use_temporary_database(directory)
+        seed_database()
+        expires = int(time.time()) + Config.SESSION_LIFETIME
+        with engine.begin() as connection:
+            connection.execute(insert(Sessions), [
+                {'sessionID': f"benchmark-{i}", 'userID': 1, 'expires': expires}
+                for i in range(session_count)])
+        session_id = f"benchmark-{session_count // 2}"
+
+        def resolve(cached):
+            def run():
+                if not cached:
+                    session_cache.clear()
+                assert DatabaseRequests(session_id).user_id is not None
+                Session.remove()
+            return run
+
+        print(f"{'session lookup (µs)':<28}{'median':>10}{'mean':>10}{'p99':>10}")
+        with engine.begin() as connection:
+            connection.execute(text("DROP INDEX ix_sessions_session_id"))
+        report("no index, no cache", time_calls(resolve(False), repeats // 10))
+        create_database(engine)
+        report("index, no cache", time_calls(resolve(False), repeats))
+        report("index, cache hit", time_calls(resolve(True), repeats))
+        Session.remove()
+
+
+def benchmark_passwords(costs=(4, 8, 10, 12), logins=48, clients=16):
+    """
+    Login throughput at each bcrypt cost, with `clients` threads logging
+    in at once through the password hasher's worker pool.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from app.database import passwords
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_temporary_database(directory)
+        print(f"{'cost':<8}{'hash ms':>10}{'logins/s':>10}{'p99 ms':>10}")
+        for rounds in (None,) + tuple(costs):
+            hasher = passwords.PasswordHasher(rounds=rounds or 4)
+            # measure the logins alone, not the upgrade of the hash
+            hasher.needs_rehash = lambda password_hash: False
+            main.password_hasher = hasher
+
+            start = time.perf_counter()
+            if rounds is None:
+                # the salted SHA-512 used before bcrypt
+                password_hash = passwords.legacy_hash("password", "salt")
+            else:
+                password_hash = hasher.hash("password")
+            hash_ms = (time.perf_counter() - start) * 1000
+
+            session = Session()
+            session.query(User).delete()
+            session.add(User(username="benchmark", password=password_hash,
+                             salt="salt", emailNotifications=False))
+            session.commit()
+            Session.remove()
+
+            def login():
+                started = time.perf_counter()
+                assert DatabaseRequests().login("benchmark", "password")
+                Session.remove()
+                return time.perf_counter() - started
+
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=clients) as executor:
+                timings = sorted(executor.map(lambda _: login(), range(logins)))
+            elapsed = time.perf_counter() - start
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))] * 1000
+            print(f"{rounds or 'sha512':<8}{hash_ms:>10.1f}{logins / elapsed:>10.1f}{p99:>10.0f}")
+        Session.remove()
+
+
+def benchmark_history(message_count=100000, repeats=200):
+    """Cost of opening a chat of message_count messages, and of paging back through it."""
+    from datetime import datetime
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = use_temporary_database(directory)
+        seed_database()
+        requests = DatabaseRequests()
+        session_id = requests.login(*SEED_USERS[0])
+        requests = DatabaseRequests(session_id)
+        requests.create_chat("benchmark", [])
+        chat_id, = requests.get_chat_ids()
+        now = int(time.time())
+        with engine.begin() as connection:
+            connection.execute(insert(ChatMessage), [
+                {'message': f"message {i}", 'chatID': chat_id, 'sender': 1,
+                 'dateSent': now - message_count + i}
+                for i in range(message_count)])
+        Session.remove()
+
+        def before():
+            # what get_chat_messages used to do: every message, as objects,
+            # with the date formatted on the server
+            session = Session()
+            [{'messageID': message.messageID, 'message': message.message,
+              'chatID': message.chatID, 'sender': message.sender,
+              'dateSent': datetime.fromtimestamp(message.dateSent).strftime('%Y-%m-%d %H:%M:%S')}
+             for message in session.query(ChatMessage).filter(
+                ChatMessage.chatID == chat_id).order_by(ChatMessage.messageID).all()]
+            Session.remove()
+
+        def latest_page():
+            assert len(DatabaseRequests(session_id).get_chat_messages(chat_id)) == \
+                Config.CHAT_HISTORY_PAGE_SIZE
+            Session.remove()
+
+        def older_page():
+            DatabaseRequests(session_id).get_chat_messages(
+                chat_id, before_message_id=message_count // 2)
+            Session.remove()
+
+        print(f"{'open a chat (µs)':<28}{'median':>10}{'mean':>10}{'p99':>10}")
+        report("whole history", time_calls(before, max(repeats // 100, 3)))
+        report("latest page", time_calls(latest_page, repeats))
+        report("older page", time_calls(older_page, repeats))
+        Session.remove()
+
+
+def benchmark_membership(chat_count=5000, repeats=2000):
+    """Cost of checking a user is in a chat, with chat_count chats of a few members each."""
+    from app.database.main import Chat, UsersChatsLink, membership_cache
+
+    with tempfile.TemporaryDirectory() as directory:
+        engine = use_temporary_database(directory)
+        seed_database()
+        with engine.begin() as connection:
+            connection.execute(insert(Chat), [{'chatName': f"chat {i}"}
+                                              for i in range(chat_count)])
+            connection.execute(insert(UsersChatsLink), [
+                {'userID': user_id, 'chatID': chat_id}
+                for chat_id in range(1, chat_count + 1)
+                for user_id in range(chat_id % 7 + 1, chat_id % 7 + 4)])
+        session_id = DatabaseRequests().login(*SEED_USERS[0])
+        chat_id = chat_count // 2 + 1
+        while chat_id % 7 != 0:
+            chat_id += 1
+
+        def before():
+            # what send_message and get_chat_messages used to run
+            requests = DatabaseRequests(session_id)
+            assert requests.session.query(UsersChatsLink).filter(
+                UsersChatsLink.chatID == chat_id,
+                UsersChatsLink.userID == requests.user_id).count() > 0
+            Session.remove()
+
+        def check(cached):
+            def run():
+                if not cached:
+                    membership_cache.clear()
+                assert DatabaseRequests(session_id).is_member(chat_id)
+                Session.remove()
+            return run
+
+        def chat_list():
+            DatabaseRequests(session_id).get_all_chats()
+            Session.remove()
+
+        print(f"{'membership check (µs)':<28}{'median':>10}{'mean':>10}{'p99':>10}")
+        report("count query", time_calls(before, repeats))
+        report("cache miss", time_calls(check(False), repeats))
+        report("cache hit", time_calls(check(True), repeats))
+        report("chat list", time_calls(chat_list, repeats // 10))
+        Session.remove()
+
+
+def benchmark_sends(senders=16, messages_per_sender=200, chats=4):
+    """
+    Messages per second with `senders` threads posting to the same few chats
+    at once, through send_message and through the message queue.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    from app.database.message_queue import MessageQueue
+
+    with tempfile.TemporaryDirectory() as directory:
+        use_temporary_database(directory)
+        seed_database()
+        session_id = DatabaseRequests().login(*SEED_USERS[0])
+        requests = DatabaseRequests(session_id)
+        for i in range(chats):
+            requests.create_chat(f"benchmark {i}", [])
+        chat_ids = sorted(requests.get_chat_ids())
+        Session.remove()
+
+        def run(send):
+            def sender(number):
+                timings = []
+                for i in range(messages_per_sender):
+                    started = time.perf_counter()
+                    assert send(DatabaseRequests(session_id),
+                                chat_ids[(number + i) % chats], f"message {i}")
+                    Session.remove()
+                    timings.append((time.perf_counter() - started) * 1000)
+                return timings
+
+            with ThreadPoolExecutor(max_workers=senders) as executor:
+                return [timing for timings in executor.map(sender, range(senders))
+                        for timing in timings]
+
+        def report_sends(name, timings, elapsed):
+            timings = sorted(timings)
+            p99 = timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+            print(f"{name:<28}{len(timings) / elapsed:>10.0f}"
+                  f"{statistics.median(timings):>10.2f}{p99:>10.2f}")
+
+        total = senders * messages_per_sender
+        print(f"{f'{senders} senders':<28}{'msgs/s':>10}{'ack ms':>10}{'p99 ms':>10}")
+        start = time.perf_counter()
+        timings = run(DatabaseRequests.send_message)
+        report_sends("send_message", timings, time.perf_counter() - start)
+
+        for batch_size in (10, 100):
+            queue = MessageQueue(journal_path=os.path.join(directory, f"journal-{batch_size}"),
+                                 batch_size=batch_size)
+            main.message_queue = queue
+            start = time.perf_counter()
+            timings = run(DatabaseRequests.queue_message)
+            queue.flush()
+            # counted until every message is committed, not only accepted
+            report_sends(f"queue, batches of {batch_size}", timings, time.perf_counter() - start)
+            queue.stop()
+            assert queue.stats['committed'] == total
+
+        session = Session()
+        assert session.query(ChatMessage).count() == total * 3
+        Session.remove()
+
+
+def deferred_engine(url):
+    """
+    An engine whose connections all read and write, starting transactions
+    with a deferred BEGIN when they first read rather than leaving it to
+    pysqlite, which only begins one before a write.
+    """
+    engine = create_engine(url, pool_size=8, max_overflow=8)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+        dbapi_connection.execute(f"PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT * 1000)}")
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN")
+
+    return engine
+
+
+def benchmark_stress(senders=8, browsers=8, logins=2, seconds=10):
+    """
+    Chat senders, people logging in and browsing chats and properties, and
+    a scraper marking listings as seen, all at once for `seconds` seconds. Run with
+    the old connection setup and with app/storage.py's (WAL, a writer and
+    a pool of readers); reports each operation's latency and "database is
+    locked" errors.
+
+    The old setup is one engine per database with a pool of connections
+    that all read and write, in rollback journal mode, each transaction
+    opened with a plain (deferred) BEGIN. A login reads the user, checks
+    the password and then writes a session in one transaction, holding a
+    shared lock all along: senders' commits wait for it, and if a sender is
+    writing when the login wants to, SQLite breaks the deadlock by failing
+    the login with "database is locked" without waiting for busy_timeout.
+    """
+    import random
+    import shutil
+    import threading
+
+    from sqlalchemy.exc import OperationalError
+
+    from app.housingApi import main as houses
+
+    houses_database = os.path.join(os.path.dirname(houses.__file__), "houses_database.db")
+
+    def run(directory, wal):
+        users_url = f"sqlite:///{os.path.join(directory, 'users.db')}"
+        houses_url = f"sqlite:///{os.path.join(directory, 'houses.db')}"
+        shutil.copy(houses_database, os.path.join(directory, 'houses.db'))
+        if wal:
+            users_engines = sqlite_engines(users_url)
+            houses_engines = sqlite_engines(houses_url)
+        else:
+            users_engines = (deferred_engine(users_url),) * 2
+            houses_engines = (deferred_engine(houses_url),) * 2
+            with houses_engines[0].connect() as connection:
+                connection.exec_driver_sql("PRAGMA journal_mode=DELETE")
+        Session.remove()
+        Session.configure(writer=users_engines[0], reader=users_engines[1])
+        houses.Session.remove()
+        houses.Session.configure(writer=houses_engines[0], reader=houses_engines[1])
+        create_database(users_engines[0])
+        houses.create_house_database(houses_engines[0])
+        session_cache.clear()
+
+        seed_database()
+        session_id = DatabaseRequests().login(*SEED_USERS[0])
+        requests = DatabaseRequests(session_id)
+        for i in range(4):
+            requests.create_chat(f"stress {i}", [])
+        chat_ids = sorted(requests.get_chat_ids())
+        urls = [url for url, in houses.Session().query(houses.House.url)]
+        Session.remove()
+        houses.Session.remove()
+
+        timings = {'send': [], 'login': [], 'read chat': [], 'search': [], 'scrape': []}
+        errors = {name: 0 for name in timings}
+        lock = threading.Lock()
+        stop = time.perf_counter() + seconds
+
+        def timed(name, function):
+            started = time.perf_counter()
+            try:
+                function()
+            except OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                with lock:
+                    errors[name] += 1
+            finally:
+                Session.remove()
+                houses.Session.remove()
+            with lock:
+                timings[name].append((time.perf_counter() - started) * 1000)
+
+        def sender():
+            while time.perf_counter() < stop:
+                timed('send', lambda: DatabaseRequests(session_id).send_message(
+                    random.choice(chat_ids), "stress"))
+
+        def login():
+            while time.perf_counter() < stop:
+                timed('login', lambda: DatabaseRequests().login(*SEED_USERS[0]))
+
+        def browser():
+            while time.perf_counter() < stop:
+                timed('read chat', lambda: DatabaseRequests(session_id).get_chat_messages(
+                    random.choice(chat_ids)))
+                timed('search', lambda: houses.HouseRequests().search_houses(
+                    max_price=random.randint(80, 300), sort="price-asc"))
+
+        def scraper():
+            while time.perf_counter() < stop:
+                timed('scrape', lambda: houses.HouseRequests().mark_seen(
+                    random.sample(urls, min(50, len(urls)))))
+
+        threads = [threading.Thread(target=sender) for _ in range(senders)]
+        threads += [threading.Thread(target=login) for _ in range(logins)]
+        threads += [threading.Thread(target=browser) for _ in range(browsers)]
+        threads.append(threading.Thread(target=scraper))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        print(f"{'WAL, writer + readers' if wal else 'rollback journal'}")
+        print(f"{'':<12}{'ops/s':>10}{'median ms':>11}{'p99 ms':>10}{'locked':>8}")
+        for name, name_timings in timings.items():
+            name_timings.sort()
+            p99 = name_timings[min(len(name_timings) - 1, int(len(name_timings) * 0.99))]
+            print(f"{name:<12}{len(name_timings) / seconds:>10.0f}"
+                  f"{statistics.median(name_timings):>11.1f}{p99:>10.1f}{errors[name]:>8}")
+
+        for engine in set(users_engines + houses_engines):
+            engine.dispose()
+
+    for wal in (False, True):
+        with tempfile.TemporaryDirectory() as directory:
+            run(directory, wal)
+        print()
+    Session.remove()
+
+
+BENCHMARKS = {
+    'requests': benchmark_requests,
+    'sessions': benchmark_sessions,
+    'passwords': benchmark_passwords,
+    'history': benchmark_history,
+    'membership': benchmark_membership,
+    'sends': benchmark_sends,
+    'stress': benchmark_stress,
+}
+
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
+        print()
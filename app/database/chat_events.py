@@ -0,0 +1,107 @@
+"""
+In-process publish/subscribe of new chat messages, feeding the
+/messages/stream Server-Sent Events endpoint.
+
+DatabaseRequests.send_message publishes each message after it is
+committed, and every open stream of a member of that chat receives it.
+Messages are handed over with publish_on_commit, which publishes them
+from the session's after_commit event, before the commit gives back the
+one writer connection (app/storage.py). The next write can't commit until
+then, so messages are published in the order of their ids, which the
+browser relies on.
+Subscriptions only live in this process; a client that misses messages
+(it reconnects, or falls too far behind) catches up from the database
+using the id of the last message it saw.
+"""
+import queue
+import threading
+
+from sqlalchemy import event
+
+from app.storage import RoutingSession
+
+# session.info key of the messages to publish when the session commits
+_PENDING = 'chat_events.pending'
+
+
+class Subscription:
+    def __init__(self, broker, chat_ids, max_pending):
+        self.broker = broker
+        self.chat_ids = frozenset(chat_ids)
+        self.messages = queue.Queue(maxsize=max_pending)
+        # set when messages had to be dropped, the stream then ends so the
+        # client reconnects and catches up from the database
+        self.overflowed = False
+
+    def get(self, timeout):
+        """The next message, or None if there was none within timeout seconds."""
+        try:
+            return self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ChatEvents:
+    def __init__(self, max_pending=1000):
+        self.max_pending = max_pending
+        self._subscriptions = {}  # chat id -> set of Subscription
+        self._lock = threading.Lock()
+
+    def subscribe(self, chat_ids):
+        subscription = Subscription(self, chat_ids, self.max_pending)
+        with self._lock:
+            for chat_id in subscription.chat_ids:
+                self._subscriptions.setdefault(chat_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for chat_id in subscription.chat_ids:
+                subscriptions = self._subscriptions.get(chat_id)
+                if subscriptions is not None:
+                    subscriptions.discard(subscription)
+                    if not subscriptions:
+                        del self._subscriptions[chat_id]
+
+    def publish(self, chat_id, message):
+        """Hands message (a dict) to every subscriber of the chat."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(chat_id, ()))
+        for subscription in subscriptions:
+            try:
+                subscription.messages.put_nowait(message)
+            except queue.Full:
+                subscription.overflowed = True
+
+    def subscriber_count(self):
+        with self._lock:
+            return len({subscription for subscriptions in self._subscriptions.values()
+                        for subscription in subscriptions})
+
+
+chat_events = ChatEvents()
+
+
+def publish_on_commit(session, chat_id, message):
+    """Publishes message (a dict) once session's transaction has committed."""
+    session.info.setdefault(_PENDING, []).append((chat_id, message))
+
+
+@event.listens_for(RoutingSession, "after_commit")
+def _publish_pending(session):
+    for chat_id, message in session.info.pop(_PENDING, ()):
+        chat_events.publish(chat_id, message)
+
+
+@event.listens_for(RoutingSession, "after_rollback")
+def _drop_pending(session):
+    session.info.pop(_PENDING, None)
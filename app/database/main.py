@@ -1,23 +1,31 @@
 # SQLAlchemy Python file for creating the database with all foreign key
 # relations
+import threading
+from collections import OrderedDict
 from functools import wraps
 
 from sqlalchemy import create_engine, Column, Integer, String, ForeignKey, \
-    Text, Boolean, Float
+    Text, Boolean, Float, Index, and_, or_, func, delete, select
 from sqlalchemy.exc import NoResultFound
-from sqlalchemy.orm import relationship, sessionmaker, declarative_base, \
-    joinedload
+from sqlalchemy.orm import relationship, declarative_base, joinedload
 from sqlalchemy import create_engine, inspect
-import hashlib
 from bcrypt import gensalt
 
+from app.config import Config
+from app.storage import chunks, routing_session, sqlite_engines
+from app.database.chat_events import publish_on_commit
+from app.database.message_queue import message_queue
+from app.database.passwords import password_hasher
+
 import time
-from datetime import datetime
 
 # Define the base for our classes
 
-engine = create_engine('sqlite:///app/database/database.db', echo=False)
-Session = sessionmaker(bind=engine)
+# a writer and a reader engine per process (see app/storage.py), each
+# thread gets its own session which is removed at the end of the request
+# (see create_app)
+engine, read_engine = sqlite_engines(Config.USERS_DATABASE_URL)
+Session = routing_session(engine, read_engine)
 Base = declarative_base()
 
 
@@ -47,6 +55,11 @@ class Sessions(Base):
     userID = Column(Integer, ForeignKey('Users.userID'))
     expires = Column(Integer)
 
+    # every authenticated request looks its session up by sessionID
+    __table_args__ = (
+        Index('ix_sessions_session_id', 'sessionID', unique=True),
+    )
+
 
 # Define the Chats table
 class Chat(Base):
@@ -62,6 +75,10 @@ class UsersChatsLink(Base):
     usersChatsLinkID = Column(Integer, primary_key=True)
     userID = Column(Integer, ForeignKey('Users.userID'), nullable=False)
     chatID = Column(Integer, ForeignKey('Chats.chatID'), nullable=False)
+    # a user's chats, and whether they are in one; each user joins a chat once
+    __table_args__ = (
+        Index('ix_users_chats_link_user_id_chat_id', 'userID', 'chatID', unique=True),
+    )
     #user = relationship('User', back_populates='chats')
     #chat = relationship('Chat', back_populates='users')
 
@@ -75,13 +92,19 @@ class ChatMessage(Base):
     sender = Column(Integer, ForeignKey('Users.userID'), nullable=False)
     dateSent = Column(Integer, nullable=False)
 
+    # a chat's messages in order, and those after a given message
+    __table_args__ = (
+        Index('ix_chat_messages_chat_id_message_id', 'chatID', 'messageID'),
+    )
+
     def to_dict(self):
         return {
             'messageID': self.messageID,
             'message': self.message,
             'chatID': self.chatID,
             'sender': self.sender,
-            'dateSent': datetime.fromtimestamp(self.dateSent).strftime('%Y-%m-%d %H:%M:%S'),
+            # seconds since the epoch, formatted by the client
+            'dateSent': self.dateSent,
         }
 
     #chat = relationship('Chat', back_populates='messages')
@@ -203,48 +226,105 @@ class UserHouseRequirementsAreasLink(Base):
 
 
 
-def msg_to_dict(f):
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        messages = f(*args, **kwargs)
-        formatted_messages = []
-        if messages is None:
-            return None
-        for message in messages:
-            formatted_messages.append(message.to_dict())
-        return formatted_messages
-    return wrapper
-
+# the columns a message is sent to clients with, selected without loading
+# ChatMessage objects
+MESSAGE_COLUMNS = (ChatMessage.messageID, ChatMessage.message, ChatMessage.chatID,
+                   ChatMessage.sender, ChatMessage.dateSent)
 
 
 def msg_to_dict(f):
+    """Turns the MESSAGE_COLUMNS rows f returns into dicts."""
     @wraps(f)
     def wrapper(*args, **kwargs):
         messages = f(*args, **kwargs)
-        formatted_messages = []
         if messages is None:
             return None
-        for message in messages:
-            formatted_messages.append(message.to_dict())
-        return formatted_messages
+        return [message._asdict() for message in messages]
     return wrapper
 
 
+class TtlLruCache:
+    """
+    In-process cache that keeps entries for at most ttl seconds, so changes
+    made by other processes are noticed, and drops the least recently used
+    past max_size.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (value, valid until)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """The cached value, or None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, valid_until = entry
+            if valid_until <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, expires=None):
+        """Caches value for ttl seconds, or until `expires` if that is sooner."""
+        valid_until = time.time() + self.ttl
+        if expires is not None:
+            valid_until = min(valid_until, expires)
+        with self._lock:
+            self._entries[key] = (value, valid_until)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# session id -> user id, so most requests don't query the Sessions table;
+# entries never outlive the session
+session_cache = TtlLruCache(Config.SESSION_CACHE_SIZE, Config.SESSION_CACHE_TTL)
+
+# user id -> frozenset of the ids of their chats, so checking a user may read
+# or post in a chat needs no query; dropped by the methods that change
+# memberships
+membership_cache = TtlLruCache(Config.MEMBERSHIP_CACHE_SIZE, Config.MEMBERSHIP_CACHE_TTL)
+
+
+# users created by seed_database for trying the site out
+SEED_USERS = [('test', 'test'), ('test2', 'test')]
+
 
 class DatabaseRequests:
+    # made on every request, so this only looks up who the session belongs
+    # to; the schema and seed users are set up by create_database and
+    # seed_database
     def __init__(self, session_id=None):
-        create_database()
         self.user_id = None
         self.session = Session()
-        self.register('test', 'test')
-        self.register('test2', 'test')
 
         if session_id is not None:
-            try:
-                self.user_id = self.session.query(Sessions).filter(
-                    Sessions.sessionID == session_id).first().userID
-            except NoResultFound:
-                self.user_id = None
+            self.user_id = session_cache.get(session_id)
+            if self.user_id is None:
+                self.user_id = self.__resolve_session(session_id)
+
+    def __resolve_session(self, session_id):
+        user_session = self.session.query(Sessions.userID, Sessions.expires).filter(
+            Sessions.sessionID == session_id,
+            Sessions.expires > time.time()).first()
+        if user_session is None or user_session.userID is None:
+            return None
+        session_cache.put(session_id, user_session.userID, user_session.expires)
+        return user_session.userID
 
     def rename_chat(self, chat_id, name):
         self.session.query(Chat).filter(Chat.chatID == chat_id).update({
@@ -352,10 +432,14 @@ class DatabaseRequests:
         if self.user_id is None:
             return False
 
-        self.session.add(UsersChatsLink(chatID=chat_id,
-                                        userID=user_id))
+        if self.session.query(UsersChatsLink.usersChatsLinkID).filter(
+                UsersChatsLink.chatID == chat_id,
+                UsersChatsLink.userID == user_id).first() is None:
+            self.session.add(UsersChatsLink(chatID=chat_id,
+                                            userID=user_id))
 
-        self.session.commit()
+            self.session.commit()
+            membership_cache.invalidate(user_id)
 
         return True
 
@@ -437,64 +521,91 @@ class DatabaseRequests:
             return None
 
 
+    def get_university_id(self):
+        link = self.session.query(UsersUniversitiesLink.universityID).filter(
+            UsersUniversitiesLink.userID == self.user_id).first()
+        return link[0] if link else None
+
     def login(self, inp_username, inp_password):
         user = self.session.query(User).filter_by(
             username=inp_username).first()
 
         if user is not None:
-            inp_password_hash = self.__hash_password(inp_password, user.salt)
-            if inp_password_hash == user.password:
+            if password_hasher.verify(inp_password, user.password, user.salt):
+                # upgrade SHA-512 hashes and hashes of an old cost
+                if password_hasher.needs_rehash(user.password):
+                    self.__set_password(user, inp_password)
                 self.user_id = user.userID
                 return self.create_user_session()
 
         return ""
 
     def register(self, username, password):
-        if (self.session.query(User).filter_by(username=username).first() is
-                not None):
+        user = self.create_user(username, password)
+        if user is None:
             return ""
 
-        salt = gensalt().decode('utf8')
-        password_hash = self.__hash_password(password, salt)
-
-        self.session.add(User(username=username, password=password_hash,
-                              salt=salt, emailNotifications=False,
-                              email=username, aboutUser="", gender="", age=0))
+        self.user_id = user.userID
+        return self.create_user_session()
 
+    def create_user(self, username, password):
+        """Adds a user, returns None if the username is taken."""
+        if (self.session.query(User).filter_by(username=username).first() is
+                not None):
+            return None
 
+        user = User(username=username, emailNotifications=False,
+                    email=username, aboutUser="", gender="", age=0)
+        self.__set_password(user, password)
+        self.session.add(user)
         self.session.commit()
 
-        return self.create_user_session()
+        return user
 
     def get_all_chats(self):
         if self.user_id is not None:
 
-            return (self.session.query(
+            chats = (self.session.query(
                 Chat
-            ).filter(
-                User.userID == UsersChatsLink.userID
-            ).filter(
-                UsersChatsLink.chatID == Chat.chatID
+            ).join(
+                UsersChatsLink, UsersChatsLink.chatID == Chat.chatID
             ).filter(
                 UsersChatsLink.userID == self.user_id
-            ).all())
+            ).order_by(Chat.chatID).all())
+            membership_cache.put(self.user_id, frozenset(chat.chatID for chat in chats))
+            return chats
         else:
             return None
 
     @msg_to_dict
-    def get_chat_messages(self, chat_id, max=500):
-
+    def get_chat_messages(self, chat_id, max=Config.CHAT_HISTORY_PAGE_SIZE,
+                          after_message_id=None, before_message_id=None):
+        """
+        Up to `max` of the chat's messages in the order sent: the first ones
+        after after_message_id if given, otherwise the latest ones (before
+        before_message_id if given). None if the user isn't in the chat.
+        """
         if self.user_id is not None:
-            if self.session.query(UsersChatsLink).filter(UsersChatsLink.chatID == chat_id, UsersChatsLink.userID == self.user_id).count() > 0:
-                messages = self.session.query(ChatMessage).filter(
-                    ChatMessage.chatID == chat_id).all()
-                return messages
+            if self.is_member(chat_id):
+                # walks ix_chat_messages_chat_id_message_id from the cursor
+                query = self.session.query(*MESSAGE_COLUMNS).filter(
+                    ChatMessage.chatID == chat_id)
+                if after_message_id is not None:
+                    return query.filter(ChatMessage.messageID > after_message_id).order_by(
+                        ChatMessage.messageID).limit(max).all()
+                if before_message_id is not None:
+                    query = query.filter(ChatMessage.messageID < before_message_id)
+                return query.order_by(ChatMessage.messageID.desc()).limit(max).all()[::-1]
         return None
 
     def create_user_session(self):
         session_id = gensalt().decode('utf8')
-        expire_date = time.time()
+        now = int(time.time())
+        expire_date = now + Config.SESSION_LIFETIME
 
+        # clear out this user's expired sessions while we're here
+        self.session.query(Sessions).filter(Sessions.userID == self.user_id,
+                                            Sessions.expires <= now).delete()
         self.session.add(Sessions(sessionID=session_id, userID=self.user_id,
                                  expires=expire_date))
 
@@ -502,19 +613,109 @@ class DatabaseRequests:
 
         return session_id
 
+    def logout(self, session_id):
+        """Ends the session, in the database and in this process's cache."""
+        session_cache.invalidate(session_id)
+        self.session.query(Sessions).filter(Sessions.sessionID == session_id).delete()
+        self.session.commit()
+        self.user_id = None
+
     def send_message(self, chat_id, message):
         if self.user_id is not None:
-            if self.session.query(UsersChatsLink).filter(
-                    UsersChatsLink.chatID == chat_id, UsersChatsLink.userID
-                                                      == self.user_id).count() > 0:
-                self.session.add(ChatMessage(message=message,
-                                             chatID=chat_id,
-                                             sender=self.user_id,
-                                             dateSent=time.time()))
+            if self.is_member(chat_id):
+                chat_message = ChatMessage(message=message,
+                                           chatID=chat_id,
+                                           sender=self.user_id,
+                                           dateSent=int(time.time()))
+                self.session.add(chat_message)
+                self.session.flush()
+                # only once committed, so subscribers can always re-read it;
+                # taken before the commit expires it, saving a query
+                publish_on_commit(self.session, chat_message.chatID, chat_message.to_dict())
                 self.session.commit()
                 return True
         return False
 
+    def queue_message(self, chat_id, message):
+        """
+        Like send_message, but hands the message to the message queue to be
+        written with others. Raises MessageQueueFull if too many are waiting.
+        """
+        # checked before it is journalled, a message that can't be stored
+        # would only be found by the writer thread
+        if chat_id is None or not isinstance(message, str) or not message.strip():
+            return False
+        if self.user_id is not None:
+            if self.is_member(chat_id):
+                message_queue.put(int(chat_id), self.user_id, message, int(time.time()))
+                return True
+        return False
+
+    def sync_chats(self, last_seen, limit=1000, page_size=Config.CHAT_HISTORY_PAGE_SIZE):
+        """
+        The messages after the last seen one of each chat, for a
+        {chat id: last seen message id or None} of the user's chats, a hundred
+        chats a query. A chat with no last seen message gets its latest
+        page_size messages. Chats the user isn't in are left out. Returns
+        ({chat id: [message dict]}, more), more meaning `limit` was reached
+        and the client should sync again.
+        """
+        if self.user_id is None:
+            return None, False
+        last_seen = {int(chat_id): message_id for chat_id, message_id in last_seen.items()}
+
+        member_chat_ids = self.get_chat_ids().intersection(last_seen)
+
+        conditions = []
+        for chat_id in member_chat_ids:
+            if last_seen[chat_id] is None:
+                # from the page_size-th latest message on
+                first_id = self.session.query(ChatMessage.messageID).filter(
+                    ChatMessage.chatID == chat_id).order_by(
+                    ChatMessage.messageID.desc()).offset(page_size - 1).limit(1).scalar_subquery()
+                conditions.append(and_(ChatMessage.chatID == chat_id,
+                                       ChatMessage.messageID >= func.coalesce(first_id, 0)))
+            else:
+                conditions.append(and_(ChatMessage.chatID == chat_id,
+                                       ChatMessage.messageID > last_seen[chat_id]))
+
+        synced = {chat_id: [] for chat_id in member_chat_ids}
+        messages = []
+        for chunk in chunks(conditions, 100):
+            messages += self.session.query(*MESSAGE_COLUMNS).filter(or_(*chunk)).order_by(
+                ChatMessage.messageID).limit(limit + 1).all()
+        messages.sort(key=lambda message: message.messageID)
+
+        for message in messages[:limit]:
+            synced[message.chatID].append(message._asdict())
+        return synced, len(messages) > limit
+
+    def get_chat_ids(self):
+        """The ids of the user's chats, a frozenset."""
+        chat_ids = membership_cache.get(self.user_id)
+        if chat_ids is None:
+            chat_ids = frozenset(chat_id for chat_id, in self.session.query(
+                UsersChatsLink.chatID).filter(UsersChatsLink.userID == self.user_id))
+            membership_cache.put(self.user_id, chat_ids)
+        return chat_ids
+
+    def is_member(self, chat_id):
+        try:
+            return int(chat_id) in self.get_chat_ids()
+        except (TypeError, ValueError):
+            return False
+
+    @msg_to_dict
+    def get_messages_since(self, message_id, limit=500):
+        """The messages after message_id in any of the user's chats, oldest first."""
+        if self.user_id is None:
+            return None
+        return self.session.query(*MESSAGE_COLUMNS).join(
+            UsersChatsLink, UsersChatsLink.chatID == ChatMessage.chatID).filter(
+            UsersChatsLink.userID == self.user_id,
+            ChatMessage.messageID > message_id).order_by(
+            ChatMessage.messageID).limit(limit).all()
+
     def create_chat(self, chat_name, people):
         if self.user_id is not None:
             new_chat = Chat(chatName=chat_name)
@@ -530,6 +731,7 @@ class DatabaseRequests:
                 self.session.add(UsersChatsLink(chatID=new_chat.chatID,
                                                 userID=person))
             self.session.commit()
+            membership_cache.invalidate(*people)
             return True
         return False
 
@@ -539,6 +741,7 @@ class DatabaseRequests:
                 UsersChatsLink.chatID == chat_id,
                 UsersChatsLink.userID == self.user_id).delete()
             self.session.commit()
+            membership_cache.invalidate(self.user_id)
             return True
         return False
 
@@ -553,16 +756,14 @@ class DatabaseRequests:
 
         return formatted_users
 
-    @staticmethod
-    def __hash_password(password, salt):
-        return hashlib.sha512(f"{password}{salt}".encode()).hexdigest()
+    def __set_password(self, user, password):
+        user.password = password_hasher.hash(password)
+        # bcrypt keeps its salt in the hash, the column is for legacy hashes
+        user.salt = user.password[:29]
 
 
 class UserRequests:
-    def __init__(self, db_url='sqlite:///app/database/database.db'):
-
-        self.engine = create_engine(db_url)
-        Session = sessionmaker(bind=self.engine)
+    def __init__(self):
         self.session = Session()
 
     def get_user_by_id(self, user_id):
@@ -628,9 +829,58 @@ class UserRequests:
             }
         return None
 
+    def get_university_location(self, university_id):
+        """Returns (lat, long) of the university or None if unknown."""
+        location = self.session.query(University.lat, University.long).filter(
+            University.universityID == university_id).first()
+        if location is None:
+            return None
+        return location.lat, location.long
+
+
+def write_messages(entries):
+    """
+    Inserts messages from the message queue, dicts with the chatID, sender,
+    message and dateSent of each, with one commit. Then publishes them.
+    """
+    session = Session()
+    try:
+        messages = [ChatMessage(message=entry['message'], chatID=entry['chatID'],
+                                sender=entry['sender'], dateSent=entry['dateSent'])
+                    for entry in entries]
+        session.add_all(messages)
+        session.flush()
+        # taken before the commit expires them, saving a query each
+        for message in messages:
+            publish_on_commit(session, message.chatID, message.to_dict())
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        Session.remove()
+
 
-def create_database():
+def create_database(engine=engine):
     Base.metadata.create_all(engine)
+    # older versions could add a user to a chat twice, which the unique
+    # index on UsersChatsLink doesn't allow
+    with engine.begin() as connection:
+        connection.execute(delete(UsersChatsLink).where(
+            UsersChatsLink.usersChatsLinkID.not_in(
+                select(func.min(UsersChatsLink.usersChatsLinkID)).group_by(
+                    UsersChatsLink.userID, UsersChatsLink.chatID))))
+    # create_all skips the indexes of tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+
+
+def seed_database():
+    """Adds the SEED_USERS that don't exist yet, returns their names."""
+    database_requests = DatabaseRequests()
+    return [username for username, password in SEED_USERS
+            if database_requests.create_user(username, password) is not None]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,337 @@
+"""
+Optional write-behind path for chat messages (Config.MESSAGE_QUEUE_ENABLED).
+
+DatabaseRequests.queue_message appends the message to a journal file and
+puts it on an in-process queue, and the sender is answered straight away.
+A single writer thread takes messages off the queue in the order they were
+accepted and inserts them in batches of up to Config.MESSAGE_QUEUE_BATCH_SIZE
+with one commit each, waiting at most Config.MESSAGE_QUEUE_FLUSH_INTERVAL
+seconds for a batch to fill. Committed messages are published to
+chat_events like those sent by DatabaseRequests.send_message.
+
+After each commit the sequence number of the last committed message is
+written to a checkpoint file next to the journal. When the process starts
+again, journalled messages past the checkpoint are inserted before any new
+ones, so accepted messages survive a crash in the order they were sent.
+A crash between a commit and its checkpoint can store that batch twice.
+
+A journal belongs to one process at a time, which holds a lock on it.
+Each process takes the first of Config.MESSAGE_QUEUE_JOURNAL_SLOTS journals
+(MESSAGE_QUEUE_JOURNAL, then MESSAGE_QUEUE_JOURNAL.1, ...) that no other
+process has, and writes out what a crashed process left in it. Where there
+is no fcntl (Windows) journals can't be locked, and every process uses
+MESSAGE_QUEUE_JOURNAL, so only run one process there.
+
+A batch that fails because the database is busy is retried. One that fails
+for any other reason is split up until the messages that can't be stored
+are found; they are appended to a dead-letter file next to the journal, so
+they don't hold up the messages queued after them.
+"""
+import atexit
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+from sqlalchemy.exc import OperationalError
+
+from app.config import Config
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# tells the writer thread to stop once it has written what came before
+_STOP = object()
+
+
+class MessageQueueFull(Exception):
+    pass
+
+
+class MessageQueueLocked(Exception):
+    """Every journal slot is in use by another process."""
+    pass
+
+
+def is_busy(error):
+    """Whether a database error is another connection holding a lock, worth retrying."""
+    return isinstance(error, OperationalError) and \
+        any(word in str(error.orig) for word in ("locked", "busy"))
+
+
+class MessageQueue:
+    def __init__(self, journal_path=Config.MESSAGE_QUEUE_JOURNAL,
+                 batch_size=Config.MESSAGE_QUEUE_BATCH_SIZE,
+                 flush_interval=Config.MESSAGE_QUEUE_FLUSH_INTERVAL,
+                 max_pending=Config.MESSAGE_QUEUE_MAX_PENDING,
+                 fsync=Config.MESSAGE_QUEUE_FSYNC,
+                 journal_slots=Config.MESSAGE_QUEUE_JOURNAL_SLOTS):
+        self.base_journal_path = journal_path
+        self.journal_slots = journal_slots
+        # set once start has claimed a journal slot
+        self.journal_path = None
+        self.checkpoint_path = None
+        self.dead_letter_path = None
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.stats = {'accepted': 0, 'committed': 0, 'batches': 0, 'retries': 0,
+                      'dead_letters': 0}
+
+        self._queue = queue.Queue(maxsize=max_pending)
+        # held while a message is numbered and journalled, so the journal
+        # and the queue have the same order
+        self._accept_lock = threading.Lock()
+        self._committed = threading.Condition()
+        self._accepted_seq = 0
+        self._committed_seq = 0
+        self._journal = None
+        self._journal_lock = None
+        self._writer = None
+        self._stop_at_exit = False
+
+    @property
+    def running(self):
+        return self._writer is not None and self._writer.is_alive()
+
+    def start(self):
+        """Writes out what the journal holds from before, then starts the writer thread."""
+        with self._accept_lock:
+            if self.running:
+                return
+            if self._writer is not None:
+                # the writer thread died. Everything it hadn't committed is in
+                # the journal, so drop the queue, which recovering would
+                # otherwise store a second time, and recover as after a crash
+                print("The message writer stopped unexpectedly, restarting it")
+                self._queue = queue.Queue(maxsize=self._queue.maxsize)
+                self._journal.close()
+                self._journal = None
+            if self._journal_lock is None:
+                self.__claim_journal()
+            self.__recover()
+            self._journal = open(self.journal_path, 'a')
+            self._writer = threading.Thread(target=self.__write_loop,
+                                            name="message-writer", daemon=True)
+            self._writer.start()
+            if not self._stop_at_exit:
+                atexit.register(self.stop)
+                self._stop_at_exit = True
+
+    def stop(self):
+        """Writes out every accepted message and stops the writer thread."""
+        with self._accept_lock:
+            if not self.running:
+                return
+            self._queue.put(_STOP)
+        self._writer.join()
+        with self._accept_lock:
+            self._journal.close()
+            self._journal = None
+            self._writer = None
+
+    def put(self, chat_id, sender, message, date_sent):
+        """
+        Accepts a message to be written, returns its sequence number.
+        Raises MessageQueueFull when Config.MESSAGE_QUEUE_MAX_PENDING
+        messages are already waiting.
+        """
+        if not self.running:
+            self.start()
+        with self._accept_lock:
+            if self._queue.full():
+                raise MessageQueueFull()
+            self._accepted_seq += 1
+            entry = {'seq': self._accepted_seq, 'chatID': chat_id, 'sender': sender,
+                     'message': message, 'dateSent': date_sent}
+            self._journal.write(json.dumps(entry) + "\n")
+            self._journal.flush()
+            if self.fsync:
+                os.fsync(self._journal.fileno())
+            self._queue.put_nowait(entry)
+            self.stats['accepted'] += 1
+            return entry['seq']
+
+    def flush(self, timeout=None):
+        """Waits until every message accepted so far is committed, returns whether it was."""
+        with self._accept_lock:
+            seq = self._accepted_seq
+        with self._committed:
+            return self._committed.wait_for(lambda: self._committed_seq >= seq, timeout)
+
+    def pending(self):
+        return self._queue.qsize()
+
+    def __write_loop(self):
+        while True:
+            entry = self._queue.get()
+            if entry is _STOP:
+                return
+            batch = [entry]
+            deadline = time.monotonic() + self.flush_interval
+            stopping = False
+            while len(batch) < self.batch_size:
+                try:
+                    entry = self._queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if entry is _STOP:
+                    stopping = True
+                    break
+                batch.append(entry)
+
+            try:
+                self.__write_batch(batch)
+            except Exception:
+                # keep writing the messages queued after this batch
+                traceback.print_exc()
+            if stopping:
+                return
+
+    def __write_batch(self, batch):
+        stored = self.__write(batch)
+
+        try:
+            self.__checkpoint(batch[-1]['seq'])
+        except OSError as e:
+            # the batch is stored; without the checkpoint a crash before the
+            # next one would only store it again
+            print(f"Could not write the message queue checkpoint: {e!r}")
+        self.stats['committed'] += stored
+        self.stats['batches'] += 1
+        with self._committed:
+            self._committed_seq = batch[-1]['seq']
+            self._committed.notify_all()
+
+        # start the journal afresh once everything in it is written
+        with self._accept_lock:
+            if self._accepted_seq == self._committed_seq and self._journal is not None:
+                try:
+                    self._journal.truncate(0)
+                    self._journal.seek(0)
+                except OSError as e:
+                    print(f"Could not empty the message queue journal: {e!r}")
+
+    def __write(self, batch):
+        """
+        Stores batch, dead-lettering the messages in it that can't be
+        stored. Returns how many were stored.
+        """
+        # imported here as main imports this module
+        from app.database.main import write_messages
+
+        delay = 0.05
+        while True:
+            try:
+                write_messages(batch)
+                return len(batch)
+            except Exception as e:
+                if is_busy(e):
+                    # the messages are in the journal, so wait for the lock
+                    # rather than drop them
+                    self.stats['retries'] += 1
+                    print(f"Writing {len(batch)} messages failed, retrying: {e!r}")
+                    time.sleep(delay)
+                    delay = min(delay * 2, 5)
+                    continue
+                if len(batch) == 1:
+                    self.__dead_letter(batch[0], e)
+                    return 0
+                break
+
+        # find the messages at fault by halves, keeping the order of the rest
+        middle = len(batch) // 2
+        return self.__write(batch[:middle]) + self.__write(batch[middle:])
+
+    def __dead_letter(self, entry, error):
+        self.stats['dead_letters'] += 1
+        print(f"Message {entry.get('seq')} can't be stored, written to "
+              f"{self.dead_letter_path}: {error!r}")
+        letter = {
+            'item': entry,
+            'error': repr(error),
+            'traceback': traceback.format_exception(error),
+            'failed_at': int(time.time()),
+        }
+        try:
+            with open(self.dead_letter_path, 'a') as file:
+                file.write(json.dumps(letter, default=str) + "\n")
+        except OSError as e:
+            print(f"Could not write dead letter {letter!r}: {e!r}")
+
+    def __claim_journal(self):
+        """Locks the first journal slot no other process holds."""
+        if fcntl is None:
+            # nothing to lock with, so the one journal, unlocked
+            self._journal_lock = open(self.base_journal_path + ".lock", 'w')
+            self.__use_journal(self.base_journal_path)
+            return
+
+        for slot in range(self.journal_slots):
+            path = self.base_journal_path if slot == 0 else f"{self.base_journal_path}.{slot}"
+            lock = open(path + ".lock", 'w')
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                lock.close()
+                continue
+            self._journal_lock = lock
+            self.__use_journal(path)
+            return
+        raise MessageQueueLocked(f"All {self.journal_slots} journals at "
+                                 f"{self.base_journal_path} are in use")
+
+    def __use_journal(self, path):
+        self.journal_path = path
+        self.checkpoint_path = path + ".checkpoint"
+        self.dead_letter_path = path + ".dead"
+
+    def __checkpoint(self, seq):
+        temporary_path = self.checkpoint_path + ".tmp"
+        with open(temporary_path, 'w') as file:
+            file.write(str(seq))
+        os.replace(temporary_path, self.checkpoint_path)
+
+    def __recover(self):
+        checkpoint = 0
+        if os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as file:
+                checkpoint = int(file.read().strip() or 0)
+        # ahead of the file if writing the checkpoint failed
+        checkpoint = max(checkpoint, self._committed_seq)
+
+        unwritten = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path) as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # a line cut short by the crash, never acknowledged
+                        continue
+                    if not isinstance(entry, dict) or not isinstance(entry.get('seq'), int):
+                        print(f"Skipping a journal entry without a sequence number: {line!r}")
+                        continue
+                    if entry['seq'] > checkpoint:
+                        unwritten.append(entry)
+
+        stored = 0
+        for start in range(0, len(unwritten), self.batch_size):
+            stored += self.__write(unwritten[start:start + self.batch_size])
+        if unwritten:
+            print(f"Wrote {stored} of {len(unwritten)} journalled messages from before the restart")
+            checkpoint = unwritten[-1]['seq']
+
+        open(self.journal_path, 'w').close()
+        self.__checkpoint(checkpoint)
+        self._accepted_seq = checkpoint
+        with self._committed:
+            self._committed_seq = checkpoint
+            self._committed.notify_all()
+
+
+message_queue = MessageQueue()
@@ -0,0 +1,84 @@
+"""
+Password hashing with bcrypt on a small, bounded pool of worker threads.
+
+bcrypt is deliberately slow, so hashes are computed off the request thread
+by at most Config.PASSWORD_HASH_WORKERS threads at a time. When more than
+Config.PASSWORD_HASH_MAX_PENDING hashes are waiting, new ones are turned
+away with PasswordHasherBusy instead of tying up more request workers.
+
+Passwords stored by older versions are salted SHA-512 hex digests; they
+still verify and are replaced with bcrypt hashes on the next login.
+"""
+import hashlib
+import hmac
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import bcrypt
+
+from app.config import Config
+
+
+class PasswordHasherBusy(Exception):
+    pass
+
+
+def is_legacy_hash(password_hash):
+    return not password_hash.startswith("$2")
+
+
+def hash_rounds(password_hash):
+    """The bcrypt cost of a hash, None for legacy hashes."""
+    if is_legacy_hash(password_hash):
+        return None
+    return int(password_hash.split("$")[2])
+
+
+def legacy_hash(password, salt):
+    return hashlib.sha512(f"{password}{salt}".encode()).hexdigest()
+
+
+class PasswordHasher:
+    def __init__(self, rounds=Config.PASSWORD_HASH_ROUNDS,
+                 workers=Config.PASSWORD_HASH_WORKERS,
+                 max_pending=Config.PASSWORD_HASH_MAX_PENDING,
+                 wait=Config.PASSWORD_HASH_WAIT):
+        self.rounds = rounds
+        self.wait = wait
+        self._executor = ThreadPoolExecutor(max_workers=workers,
+                                            thread_name_prefix="password-hasher")
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+
+    def hash(self, password):
+        """A bcrypt hash of password at the configured cost."""
+        return self.__run(self.__hash, password)
+
+    def verify(self, password, password_hash, salt=""):
+        """Whether password matches a bcrypt or legacy hash."""
+        return self.__run(self.__verify, password, password_hash, salt)
+
+    def needs_rehash(self, password_hash):
+        return hash_rounds(password_hash) != self.rounds
+
+    def __hash(self, password):
+        return bcrypt.hashpw(password.encode(), bcrypt.gensalt(self.rounds)).decode()
+
+    @staticmethod
+    def __verify(password, password_hash, salt):
+        if is_legacy_hash(password_hash):
+            return hmac.compare_digest(legacy_hash(password, salt), password_hash)
+        return bcrypt.checkpw(password.encode(), password_hash.encode())
+
+    def __run(self, function, *args):
+        if not self._slots.acquire(timeout=self.wait):
+            raise PasswordHasherBusy()
+        try:
+            future = self._executor.submit(function, *args)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future.result()
+
+
+password_hasher = PasswordHasher()
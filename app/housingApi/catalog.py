@@ -0,0 +1,339 @@
+"""
+In-memory copy of the houses table, stored as one compact array per column,
+that answers property searches without going to SQLite, when
+Config.HOUSE_CATALOG_ENABLED is set, and backs the map's spatial index
+(see spatial.py) whether or not it is.
+
+The copy is reloaded when the catalog version bumped by
+HouseRequests.add_house and HouseRequests.update_area_for_all_houses changes.
+"""
+import math
+import sys
+import time
+from array import array
+from bisect import bisect_right
+
+from app.housingApi.main import CatalogCache, House, HouseRequests, SORT_OPTIONS, \
+    encode_cursor, decode_cursor, get_cover_images
+
+# stored in integer columns in place of NULL
+MISSING = -1
+
+
+class CatalogSnapshot:
+    """
+    Every house at one catalog version. Never modified once built, so it can
+    be shared between request threads.
+    """
+
+    def __init__(self, version, houses, cover_images):
+        self.version = version
+
+        self.ids = array('i')
+        self.price = array('d')
+        self.bedrooms = array('h')
+        self.bathrooms = array('h')
+        self.bills_inc = array('b')
+        self.wifi_inc = array('b')
+        self.x_coord = array('d')
+        self.y_coord = array('d')
+        # areas are stored as an index into area_names, 0 meaning no area
+        self.area_codes = array('H')
+        self.area_names = [None]
+        self.postal_codes = []
+        self.images = []
+
+        area_lookup = {None: 0}
+        for house in houses:
+            self.ids.append(house.id)
+            self.price.append(_float_or_nan(house.price_pp_pw))
+            self.bedrooms.append(_int_or_missing(house.bedrooms))
+            self.bathrooms.append(_int_or_missing(house.bathrooms))
+            self.bills_inc.append(_int_or_missing(house.bills_inc))
+            self.wifi_inc.append(_int_or_missing(house.wifi_inc))
+            self.x_coord.append(_float_or_nan(house.x_coord))
+            self.y_coord.append(_float_or_nan(house.y_coord))
+
+            if house.area not in area_lookup:
+                area_lookup[house.area] = len(self.area_names)
+                self.area_names.append(house.area)
+            self.area_codes.append(area_lookup[house.area])
+
+            self.postal_codes.append(house.postal_code)
+            self.images.append(cover_images.get(house.id))
+
+        self.area_lookup = area_lookup
+
+        # positions of the houses in the order of each sort option, houses
+        # without a value for the sorted column are left out like in SQL
+        self.sort_orders = {}
+        for sort, (column_name, descending) in SORT_OPTIONS.items():
+            self.sort_orders[sort] = self.__sort_order(column_name, descending)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, min_price=None, max_price=None, bedrooms=None,
+               bathrooms=None, area=None, bills_inc=None, wifi_inc=None,
+               sort="price-asc", cursor=None, limit=24):
+        """
+        Same arguments and result as HouseRequests.search_houses.
+        """
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, not {limit}")
+        if sort not in SORT_OPTIONS:
+            raise ValueError(f"Unknown sort option: {sort}")
+        column_name, descending = SORT_OPTIONS[sort]
+        order = self.sort_orders[sort]
+        sort_key = self.__sort_key(column_name, descending)
+
+        start = 0
+        if cursor is not None:
+            last_value, last_id = decode_cursor(cursor)
+            if descending:
+                start = bisect_right(order, (-last_value, -last_id), key=sort_key)
+            else:
+                start = bisect_right(order, (last_value, last_id), key=sort_key)
+
+        matches = self.__matcher(min_price, max_price, bedrooms, bathrooms,
+                                 area, bills_inc, wifi_inc)
+
+        # collect one extra house to find out whether there is another page
+        positions = []
+        for position in range(start, len(order)):
+            i = order[position]
+            if matches(i):
+                positions.append(i)
+                if len(positions) > limit:
+                    break
+
+        next_cursor = None
+        if len(positions) > limit:
+            positions = positions[:limit]
+            last = positions[-1]
+            next_cursor = encode_cursor(self.__value(column_name, last),
+                                        self.ids[last])
+
+        return {
+            'houses': [self.house_dict(i) for i in positions],
+            'next_cursor': next_cursor
+        }
+
+    def house_dict(self, i):
+        """
+        The house at position i, with the fields of House.to_dict used by
+        the property list plus its cover image.
+        """
+        return {
+            'id': self.ids[i],
+            'bedrooms': self.__value('bedrooms', i),
+            'bathrooms': self.__value('bathrooms', i),
+            'postal_code': self.postal_codes[i],
+            'x_coord': _nan_to_none(self.x_coord[i]),
+            'y_coord': _nan_to_none(self.y_coord[i]),
+            'price_pp_pw': self.__value('price_pp_pw', i),
+            'bills_inc': _missing_to_bool(self.bills_inc[i]),
+            'wifi_inc': _missing_to_bool(self.wifi_inc[i]),
+            'area': self.area_names[self.area_codes[i]],
+            'image': self.images[i],
+        }
+
+    def memory_usage(self):
+        """
+        Returns (bytes held in array columns, bytes held in Python objects).
+        """
+        arrays = [self.ids, self.price, self.bedrooms, self.bathrooms,
+                  self.bills_inc, self.wifi_inc, self.x_coord, self.y_coord,
+                  self.area_codes, *self.sort_orders.values()]
+        array_bytes = sum(column.itemsize * len(column) for column in arrays)
+
+        object_bytes = 0
+        for column in (self.postal_codes, self.images, self.area_names):
+            object_bytes += sys.getsizeof(column)
+            object_bytes += sum(sys.getsizeof(value) for value in column
+                                if value is not None)
+        return array_bytes, object_bytes
+
+    def __value(self, column_name, i):
+        if column_name == 'price_pp_pw':
+            price = self.price[i]
+            if math.isnan(price):
+                return None
+            return int(price) if price.is_integer() else price
+
+        value = getattr(self, column_name)[i]
+        return None if value == MISSING else value
+
+    def __sort_key(self, column_name, descending):
+        ids = self.ids
+        values = self.price if column_name == 'price_pp_pw' \
+            else getattr(self, column_name)
+        if descending:
+            return lambda i: (-values[i], -ids[i])
+        return lambda i: (values[i], ids[i])
+
+    def __sort_order(self, column_name, descending):
+        positions = [i for i in range(len(self.ids))
+                     if self.__value(column_name, i) is not None]
+        positions.sort(key=self.__sort_key(column_name, descending))
+        return array('i', positions)
+
+    def __matcher(self, min_price, max_price, bedrooms, bathrooms, area,
+                  bills_inc, wifi_inc):
+        checks = []
+        price = self.price
+        if min_price is not None:
+            checks.append(lambda i: price[i] >= min_price)
+        if max_price is not None:
+            checks.append(lambda i: price[i] <= max_price)
+        if bedrooms:
+            checks.append(_count_matcher(self.bedrooms, bedrooms))
+        if bathrooms:
+            checks.append(_count_matcher(self.bathrooms, bathrooms))
+        if area:
+            area_code = self.area_lookup.get(area)
+            area_codes = self.area_codes
+            checks.append(lambda i: area_codes[i] == area_code)
+        if bills_inc is not None:
+            bills = self.bills_inc
+            checks.append(lambda i: bills[i] == int(bills_inc))
+        if wifi_inc is not None:
+            wifi = self.wifi_inc
+            checks.append(lambda i: wifi[i] == int(wifi_inc))
+
+        return lambda i: all(check(i) for check in checks)
+
+
+class HouseCatalog(CatalogCache):
+    """Keeps the CatalogSnapshot of the current catalog version."""
+
+    def snapshot(self):
+        return self.get()
+
+    def search(self, **kwargs):
+        return self.snapshot().search(**kwargs)
+
+    def load(self, session, version):
+        return load_snapshot(session, version)
+
+
+def load_snapshot(session, version):
+    houses = session.query(House.id, House.price_pp_pw, House.bedrooms,
+                           House.bathrooms, House.bills_inc, House.wifi_inc,
+                           House.x_coord, House.y_coord, House.area,
+                           House.postal_code).filter(House.delisted_at.is_(None)).all()
+    cover_images = get_cover_images(session, [house.id for house in houses])
+    return CatalogSnapshot(version, houses, cover_images)
+
+
+def _count_matcher(column, counts):
+    # mirrors count_filter in main.py
+    exact = set()
+    at_least = None
+    for count in counts:
+        count = str(count)
+        if count.endswith("+"):
+            minimum = int(count[:-1])
+            at_least = minimum if at_least is None else min(at_least, minimum)
+        else:
+            exact.add(int(count))
+
+    def matches(i):
+        value = column[i]
+        if value == MISSING:
+            return False
+        return value in exact or (at_least is not None and value >= at_least)
+    return matches
+
+
+def _int_or_missing(value):
+    return MISSING if value is None else int(value)
+
+
+def _float_or_nan(value):
+    return math.nan if value is None else float(value)
+
+
+def _nan_to_none(value):
+    return None if math.isnan(value) else value
+
+
+def _missing_to_bool(value):
+    return None if value == MISSING else bool(value)
+
+
+catalog = HouseCatalog()
+
+
+if __name__ == "__main__":
+    # Benchmark: memory per 10k houses and search latency against SQLite
+    import random
+    import statistics
+
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import StaticPool
+
+    from app.housingApi.main import create_house_database, Image
+
+    house_count = 10000
+    bench_engine = create_engine("sqlite://", poolclass=StaticPool)
+    create_house_database(bench_engine)
+    bench_session = sessionmaker(bind=bench_engine)()
+
+    areas = ["Fallowfield", "Withington", "Rusholme", "Victoria Park",
+             "Hulme", "Didsbury", "City Centre", None]
+    rng = random.Random(0)
+    bench_session.add_all(House(
+        id=i, bedrooms=rng.randint(1, 10), bathrooms=rng.randint(1, 4),
+        postal_code=f"M{rng.randint(1, 40)} {rng.randint(1, 9)}AB",
+        price_pp_pw=round(rng.uniform(80, 300), 2),
+        bills_inc=rng.random() < 0.7, wifi_inc=rng.random() < 0.8,
+        x_coord=-2.23 + rng.uniform(-0.05, 0.05),
+        y_coord=53.46 + rng.uniform(-0.05, 0.05),
+        area=rng.choice(areas), url=f"https://example.com/{i}")
+        for i in range(1, house_count + 1))
+    bench_session.add_all(Image(house_id=i, url=f"https://example.com/{i}/1.jpg")
+                          for i in range(1, house_count + 1))
+    bench_session.commit()
+
+    start = time.perf_counter()
+    snapshot = load_snapshot(bench_session, 1)
+    load_time = time.perf_counter() - start
+    array_bytes, object_bytes = snapshot.memory_usage()
+    print(f"loaded {len(snapshot)} houses in {load_time * 1000:.1f} ms")
+    print(f"memory per 10k houses: {array_bytes * 10000 / len(snapshot) / 1024:.0f} KiB "
+          f"in arrays, {object_bytes * 10000 / len(snapshot) / 1024:.0f} KiB in "
+          f"strings (postcodes, image urls, area names)")
+
+    house_requests = HouseRequests()
+    house_requests.session = bench_session
+
+    queries = {
+        "first page": {},
+        "max price 150": {"max_price": 150},
+        "4+ bedrooms, bills": {"bedrooms": ["4+"], "bills_inc": True,
+                               "sort": "price-desc"},
+        "area + 2 bathrooms": {"area": "Fallowfield", "bathrooms": ["2"]},
+        "rare match": {"min_price": 299, "bedrooms": ["10"]},
+    }
+
+    def time_search(search, kwargs, repeats=50):
+        timings = []
+        result = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = search(**kwargs)
+            # follow the cursor once so keyset lookups are measured too
+            if result['next_cursor'] is not None:
+                search(cursor=result['next_cursor'], **kwargs)
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000, result
+
+    print(f"{'query':<22}{'catalog ms':>12}{'sqlite ms':>12}")
+    for name, kwargs in queries.items():
+        catalog_ms, catalog_result = time_search(snapshot.search, kwargs)
+        sql_ms, sql_result = time_search(house_requests.search_houses, kwargs)
+        assert [house['id'] for house in catalog_result['houses']] == \
+            [house['id'] for house in sql_result['houses']], name
+        print(f"{name:<22}{catalog_ms:>12.3f}{sql_ms:>12.3f}")
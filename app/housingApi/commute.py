@@ -0,0 +1,171 @@
+"""
+Batch job filling the time_to_place table with travel times from every house
+to each university and to the city centre, for every transport type.
+
+Times are estimated offline from the straight-line distance, a detour factor
+for the road network and an average speed per transport type. Only houses
+that are new, have moved, or are missing a destination, and destinations
+that have moved, are recomputed.
+
+Run with: python -m app.housingApi.commute
+"""
+from sqlalchemy import delete, insert
+
+from app.database.main import Session as UserSession, University
+from app.housingApi.main import Session, House, TimeToPlace, TransportType
+from app.housingApi.spatial import haversine_many
+from app.storage import chunks
+
+# St Peter's Square
+CITY_CENTRE = (53.4780, -2.2445)
+
+# transport type: (average speed in km/h, fixed minutes for waiting/parking)
+TRANSPORT_MODES = {
+    "walking": (5.0, 0),
+    "cycling": (15.0, 2),
+    "bus": (16.0, 6),
+    "driving": (25.0, 5),
+}
+
+# roads are longer than the straight line between two points
+DETOUR_FACTOR = 1.3
+
+
+def estimate_minutes(distance_km, transport):
+    speed_kmh, overhead_minutes = TRANSPORT_MODES[transport]
+    return round(distance_km * DETOUR_FACTOR / speed_kmh * 60 + overhead_minutes)
+
+
+def get_destinations(user_session=None):
+    """
+    {destination key: (lat, long)} for the city centre and every university
+    with a known location.
+    """
+    user_session = user_session or UserSession()
+    destinations = {"city_centre": CITY_CENTRE}
+    for university in user_session.query(University).all():
+        # universities added from the account page have no location yet
+        if university.lat or university.long:
+            destinations[f"university:{university.universityID}"] = \
+                (university.lat, university.long)
+    return destinations
+
+
+def get_transport_type_ids(session):
+    """{name: id} of the transport types, adding any that are missing."""
+    ids = {transport.name: transport.id
+           for transport in session.query(TransportType).all()}
+    for name in TRANSPORT_MODES:
+        if name not in ids:
+            transport = TransportType(name=name)
+            session.add(transport)
+            session.flush()
+            ids[name] = transport.id
+    return ids
+
+
+def update_commute_times(session=None, user_session=None):
+    """
+    Recomputes the travel times of houses that are new or have moved and
+    drops those of houses that lost their coordinates, in one transaction.
+    Returns counts of recomputed, removed and unchanged houses.
+    """
+    session = session or Session()
+    destinations = get_destinations(user_session)
+    transport_ids = get_transport_type_ids(session)
+
+    # what every house's current times were computed from
+    computed = {}
+    for house_id, destination, destination_lat, destination_long, origin_x, origin_y in \
+            session.query(TimeToPlace.house_id, TimeToPlace.destination,
+                          TimeToPlace.destination_lat, TimeToPlace.destination_long,
+                          TimeToPlace.origin_x, TimeToPlace.origin_y).distinct():
+        origin, house_destinations = computed.setdefault(
+            house_id, ((origin_x, origin_y), set()))
+        house_destinations.add((destination, destination_lat, destination_long))
+
+    # a university that has moved makes every house's time to it stale
+    expected = {(destination, lat, lon) for destination, (lat, lon) in destinations.items()}
+    stale = []
+    removed_ids = []
+    unchanged = 0
+    for house_id, x_coord, y_coord in session.query(House.id, House.x_coord,
+                                                     House.y_coord):
+        if x_coord is None or y_coord is None:
+            if house_id in computed:
+                removed_ids.append(house_id)
+        elif computed.get(house_id) != ((x_coord, y_coord), expected):
+            stale.append((house_id, x_coord, y_coord))
+        else:
+            unchanged += 1
+
+    outdated_ids = removed_ids + [house_id for house_id, _, _ in stale]
+    for chunk in chunks(outdated_ids):
+        session.execute(delete(TimeToPlace).where(TimeToPlace.house_id.in_(chunk)))
+
+    lons = [x_coord for _, x_coord, _ in stale]
+    lats = [y_coord for _, _, y_coord in stale]
+    rows = []
+    for destination, (lat, lon) in destinations.items():
+        distances = haversine_many(lat, lon, lats, lons, range(len(stale)))
+        for (house_id, x_coord, y_coord), distance in zip(stale, distances):
+            for transport, transport_id in transport_ids.items():
+                if transport not in TRANSPORT_MODES:
+                    continue
+                rows.append({
+                    'house_id': house_id,
+                    'transport_type_id': transport_id,
+                    'time_to_place': estimate_minutes(distance, transport),
+                    'destination': destination,
+                    'destination_lat': lat,
+                    'destination_long': lon,
+                    'origin_x': x_coord,
+                    'origin_y': y_coord,
+                })
+
+    if rows:
+        session.execute(insert(TimeToPlace), rows)
+    session.commit()
+
+    return {
+        'recomputed': len(stale),
+        'removed': len(removed_ids),
+        'unchanged': unchanged,
+    }
+
+
+def requirement_filters(house_requirements, university_id=None,
+                        transport="walking"):
+    """
+    search_houses keyword arguments for a user's house requirements, as in
+    the "houseRequirements" of DatabaseRequests.get_user_info. The maximum
+    distances are straight-line kilometres, turned into the time
+    estimate_minutes gives for that distance by `transport`, so a house
+    passes when it is within the distance; zero means no limit. There is no
+    station or bus stop data, so maxDistToStation and maxDistToBusStop are
+    not applied. Raises ValueError for an unknown transport.
+    """
+    if transport not in TRANSPORT_MODES:
+        raise ValueError(f"Unknown transport {transport!r}")
+    filters = {'transport': transport}
+    if house_requirements.get('maxPrice'):
+        filters['max_price'] = house_requirements['maxPrice']
+    if house_requirements.get('houseRooms'):
+        filters['bedrooms'] = [str(house_requirements['houseRooms'])]
+    if house_requirements.get('maxDistToUni') and university_id is not None:
+        filters['max_minutes_to_uni'] = estimate_minutes(
+            house_requirements['maxDistToUni'], transport)
+        filters['university_id'] = university_id
+    if house_requirements.get('maxDistToCityCenter'):
+        filters['max_minutes_to_city_centre'] = estimate_minutes(
+            house_requirements['maxDistToCityCenter'], transport)
+    return filters
+
+
+if __name__ == "__main__":
+    from app.database.main import create_database
+    from app.housingApi.main import create_house_database
+
+    create_database()
+    create_house_database()
+    print(update_commute_times())
@@ -0,0 +1,172 @@
+"""
+Geocoding of scraped listing addresses through Nominatim, cached in the
+geocode_cache table.
+
+A scrape sees the same road names again and again, so lookups are deduped
+by normalized place and answered from the cache while fresh. Misses go out
+one at a time through a pooled HTTP session, no faster than
+Config.GEOCODER_REQUESTS_PER_SECOND.
+"""
+import re
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.config import Config
+from app.housingApi.main import Session, GeocodeResult
+from app.storage import chunks
+
+UK_POSTCODE = re.compile(r'^[A-Z]{1,2}[0-9][A-Z0-9]? ?[0-9][A-Z]{2}$')
+
+
+def normalize_place(area, city):
+    """Cache key for an address, ignoring case, spacing and punctuation."""
+    place = f"{area}, {city}".lower()
+    place = re.sub(r"[^\w,]+", " ", place)
+    return ", ".join(" ".join(part.split()) for part in place.split(",") if part.strip())
+
+
+def clean_postcode(postcode):
+    """The postcode in its usual form, or None if it isn't a full UK postcode."""
+    if not postcode:
+        return None
+    postcode = " ".join(postcode.upper().split())
+    if not UK_POSTCODE.match(postcode):
+        return None
+    if " " not in postcode:
+        postcode = f"{postcode[:-3]} {postcode[-3:]}"
+    return postcode
+
+
+class RateLimiter:
+    """Spaces calls to wait() at least 1 / requests_per_second apart."""
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second if requests_per_second else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                time.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+
+def http_session(user_agent=Config.GEOCODER_USER_AGENT):
+    """A requests.Session keeping its connections to the geocoder open."""
+    http = requests.Session()
+    http.headers['User-Agent'] = user_agent
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=4, max_retries=2)
+    http.mount('https://', adapter)
+    http.mount('http://', adapter)
+    return http
+
+
+class Geocoder:
+    """
+    Resolves (area, city) pairs to {"postcode", "lat", "lon"}. postcode is
+    None when the geocoder gave none or gave something that isn't a
+    postcode; a place that wasn't found at all resolves to None.
+    """
+
+    def __init__(self, session=None, http=None,
+                 requests_per_second=Config.GEOCODER_REQUESTS_PER_SECOND,
+                 ttl=Config.GEOCODE_CACHE_TTL,
+                 not_found_ttl=Config.GEOCODE_NOT_FOUND_TTL,
+                 url=Config.GEOCODER_URL, timeout=10, rate_limiter=None):
+        self.session = session or Session()
+        self.http = http or http_session()
+        # pass a shared rate_limiter to keep several geocoders under one limit
+        self.rate_limiter = rate_limiter or RateLimiter(requests_per_second)
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self.url = url
+        self.timeout = timeout
+        self.stats = {'cached': 0, 'fetched': 0, 'failed': 0}
+
+    def resolve(self, area, city):
+        return self.resolve_many([(area, city)])[(area, city)]
+
+    def resolve_many(self, addresses):
+        """
+        {(area, city): result} for every address. Each distinct place is
+        looked up at most once, and only if it isn't cached or its cached
+        result has expired. Lookups that fail (network or HTTP errors) give
+        None and are not cached, so they are retried next time.
+        """
+        addresses = list(dict.fromkeys(addresses))
+        places = {address: normalize_place(*address) for address in addresses}
+
+        results = self.__cached(set(places.values()))
+        self.stats['cached'] += len(results)
+
+        fetched = []
+        for place in dict.fromkeys(places.values()):
+            if place in results:
+                continue
+            try:
+                result = self.__fetch(place)
+            except (requests.RequestException, ValueError) as e:
+                print(f"Could not geocode {place}: {e}")
+                self.stats['failed'] += 1
+                results[place] = None
+                continue
+            self.stats['fetched'] += 1
+            results[place] = result
+            fetched.append({
+                'place': place,
+                'found': result is not None,
+                'postcode': result and result['postcode'],
+                'lat': result and result['lat'],
+                'lon': result and result['lon'],
+                'fetched_at': int(time.time()),
+            })
+
+        for chunk in chunks(fetched, 100):
+            statement = sqlite_insert(GeocodeResult).values(chunk)
+            statement = statement.on_conflict_do_update(
+                index_elements=[GeocodeResult.place],
+                set_={column: statement.excluded[column]
+                      for column in ('found', 'postcode', 'lat', 'lon', 'fetched_at')})
+            self.session.execute(statement)
+        self.session.commit()
+
+        return {address: results[place] for address, place in places.items()}
+
+    def __cached(self, places):
+        now = int(time.time())
+        cached = {}
+        for chunk in chunks(places):
+            for row in self.session.query(GeocodeResult).filter(
+                    GeocodeResult.place.in_(chunk)):
+                ttl = self.ttl if row.found else self.not_found_ttl
+                if now - row.fetched_at >= ttl:
+                    continue
+                cached[row.place] = {'postcode': row.postcode, 'lat': row.lat,
+                                     'lon': row.lon} if row.found else None
+        return cached
+
+    def __fetch(self, place):
+        self.rate_limiter.wait()
+        response = self.http.get(self.url, timeout=self.timeout, params={
+            'q': place,
+            'format': 'json',
+            'addressdetails': 1,
+            'limit': 1,
+            'countrycodes': 'gb',
+        })
+        response.raise_for_status()
+        data = response.json()
+        if not data:
+            return None
+        return {
+            'postcode': clean_postcode(data[0].get('address', {}).get('postcode')),
+            'lat': float(data[0]['lat']),
+            'lon': float(data[0]['lon']),
+        }
@@ -0,0 +1,156 @@
+"""
+Parses the text of a listing card from the results pages, e.g.
+
+    2 bathrooms 5 Bedroom Student House Kensington Avenue, Victoria Park
+    £140.99 per person per week Available from 1st July 2025
+
+Each field is found by its own precompiled pattern, so a field moving
+around the card or a new badge ("Featured", "Bills Included", ...) doesn't
+break the others. No I/O happens here; geocoding and storing the listing
+are up to the caller.
+
+Run with: python -m app.housingApi.listing_parser
+to check the parser against the saved corpus and time it.
+"""
+import calendar
+import datetime
+import json
+import os.path
+import re
+from dataclasses import dataclass
+
+# listing texts with the fields they should parse to, one JSON object a line
+CORPUS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           "fixtures", "listing_corpus.jsonl")
+
+BATHROOMS = re.compile(r'(\d+)\s+bathrooms?\b', re.IGNORECASE)
+BEDROOMS = re.compile(r'(\d+)\s+bed(?:room)?s?\b', re.IGNORECASE)
+# the property type ends the title and the address follows it
+TITLE = re.compile(r'\b(?:(Studio)\s+)?(?:Student\s+)?(House|Apartment|Flat|Studio)\b\s*'
+                   r'(?P<road>[^,£]+?)\s*,\s*(?P<district>[^£]+?)\s*£', re.IGNORECASE)
+PRICE = re.compile(r'£\s*(\d[\d,]*(?:\.\d{1,2})?)\s*(?:per\s+person\s+)?'
+                   r'(?:per\s+week|pppw|ppw|pw)\b', re.IGNORECASE)
+AVAILABLE_FROM = re.compile(r'Available\s+from\s+(\d{1,2})(?:st|nd|rd|th)?\s+'
+                            r'([A-Za-z]+)\s+(\d{4})', re.IGNORECASE)
+ORDINAL_DATE = re.compile(r'(\d{1,2})(?:st|nd|rd|th)?\s+([A-Za-z]+)\s+(\d{4})')
+
+MONTHS = {name.lower(): number for number, name in enumerate(calendar.month_name) if name}
+MONTHS.update({name.lower(): number for number, name in enumerate(calendar.month_abbr) if name})
+MONTHS['sept'] = 9
+
+
+class ListingParseError(ValueError):
+    pass
+
+
+@dataclass(slots=True, frozen=True)
+class ParsedListing:
+    bedrooms: int
+    bathrooms: int
+    property_type: str
+    road: str
+    district: str
+    price_pp_pw: float
+    available_from: int | None  # seconds since the epoch, midnight UTC
+
+
+def parse_listing(text):
+    """
+    Parses a listing's text into a ParsedListing. Raises ListingParseError
+    naming the first field that couldn't be found.
+    """
+    title = TITLE.search(text)
+    if title is None:
+        raise ListingParseError(f"No property type and address in {text!r}")
+    studio, property_type = title.group(1, 2)
+
+    bedrooms = BEDROOMS.search(text)
+    if bedrooms is not None:
+        bedrooms = int(bedrooms.group(1))
+    elif studio or property_type.lower() == "studio":
+        bedrooms = 1
+    else:
+        raise ListingParseError(f"No bedrooms in {text!r}")
+
+    bathrooms = BATHROOMS.search(text)
+    if bathrooms is None:
+        raise ListingParseError(f"No bathrooms in {text!r}")
+
+    price = PRICE.search(text)
+    if price is None:
+        raise ListingParseError(f"No weekly price in {text!r}")
+
+    available_from = AVAILABLE_FROM.search(text)
+    if available_from is not None:
+        available_from = _epoch(*available_from.groups())
+
+    return ParsedListing(
+        bedrooms=bedrooms,
+        bathrooms=int(bathrooms.group(1)),
+        property_type="Studio" if studio else property_type.title(),
+        road=title.group('road'),
+        district=title.group('district'),
+        price_pp_pw=float(price.group(1).replace(",", "")),
+        available_from=available_from,
+    )
+
+
+def date_to_epoch(date_str):
+    """Seconds since the epoch of a date like "1st July 2025", at midnight UTC."""
+    match = ORDINAL_DATE.fullmatch(date_str.strip())
+    if match is None:
+        raise ListingParseError(f"Not a date: {date_str!r}")
+    return _epoch(*match.groups())
+
+
+def _epoch(day, month, year):
+    month_number = MONTHS.get(month.lower())
+    if month_number is None:
+        raise ListingParseError(f"Unknown month: {month!r}")
+    try:
+        return calendar.timegm(datetime.date(int(year), month_number, int(day)).timetuple())
+    except ValueError:
+        raise ListingParseError(f"Not a date: {day} {month} {year}")
+
+
+def load_corpus(path=CORPUS_FILE):
+    with open(path) as file:
+        return [json.loads(line) for line in file if line.strip()]
+
+
+def check_corpus(corpus):
+    """
+    Listing texts in the corpus that don't parse to their expected fields,
+    an expected value of null meaning the text should be rejected.
+    """
+    failures = []
+    for case in corpus:
+        try:
+            parsed = parse_listing(case['text'])
+        except ListingParseError as e:
+            if case['expected'] is not None:
+                failures.append((case['text'], str(e)))
+            continue
+        fields = {name: getattr(parsed, name) for name in ParsedListing.__slots__}
+        if fields != case['expected']:
+            failures.append((case['text'], fields))
+    return failures
+
+
+if __name__ == "__main__":
+    import time
+
+    corpus = load_corpus()
+    failures = check_corpus(corpus)
+    for text, got in failures:
+        print(f"FAIL {text!r}\n     got {got}")
+    print(f"{len(corpus) - len(failures)}/{len(corpus)} corpus listings parsed as expected")
+
+    texts = [case['text'] for case in corpus if case['expected'] is not None]
+    rounds = 200
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for text in texts:
+            parse_listing(text)
+    elapsed = time.perf_counter() - start
+    print(f"{len(texts) * rounds / elapsed:,.0f} listings parsed per second")
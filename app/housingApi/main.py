@@ -1,13 +1,24 @@
+import abc
+import base64
+import hashlib
+import json
 import os
 import os.path
+import re
+import threading
+import time
 from functools import wraps
 
 from flask import url_for
-from sqlalchemy import Column
+from sqlalchemy import Column, Index
 from sqlalchemy import Integer, String
-from sqlalchemy import create_engine, ForeignKey, Boolean
+from sqlalchemy import create_engine, ForeignKey, Boolean, Float
+from sqlalchemy import delete, func, insert, inspect, or_, select, text, tuple_, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import declarative_base, sessionmaker
-from app.housingApi.postcode_function import get_manchester_area
+from app.config import Config
+from app.storage import chunks, routing_session, sqlite_engines
+from app.housingApi.postcode_function import resolver as postcode_resolver
 import requests
 
 # wrapper so wrapped function just returns a list of ids
@@ -31,72 +42,249 @@ def add_image(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         houses_dicts = f(*args, **kwargs)
+        cover_images = get_cover_images(args[0].session,
+                                        [house_dict['id'] for house_dict in houses_dicts])
         for house_dict in houses_dicts:
-            house_dict['image'] = args[0].session.query(Image).filter_by(id=house_dict['id']).first().url
+            house_dict['image'] = cover_images.get(house_dict['id'])
         return houses_dicts
     return wrapper
 
 
+def get_cover_images(session, house_ids):
+    """
+    Returns {house id: url} of the first image of every house, loaded in a
+    single query however many houses are asked for.
+    """
+    if not house_ids:
+        return {}
+
+    first_image_ids = (session.query(func.min(Image.id).label('id'))
+                       .filter(Image.house_id.in_(house_ids))
+                       .group_by(Image.house_id)
+                       .subquery())
+    rows = (session.query(Image.house_id, Image.url)
+            .join(first_image_ids, Image.id == first_image_ids.c.id)
+            .all())
+    return {house_id: url for house_id, url in rows}
+
+
 def flaskify_images(f):
     @wraps(f)
     def wrapper(*args, **kwargs):
         id = args[0]
         formatted_images = []
         image_list = f(*args, **kwargs)
-        for image in image_list:
-            formatted_images.append(url_for('static',
-                                            filename=f"images_for_houses/"
-                                                     f"{id}/{image}"))
+        # the content hash in the url lets browsers cache the image forever
+        for image, content_hash in image_list:
+            formatted_images.append(url_for('main.house_image', house_id=id,
+                                            filename=image, v=content_hash))
         return formatted_images
     return wrapper
 
 
-class HouseRequests:
-    def __init__(self):
-        self.engine = create_engine("sqlite:///app/housingApi/houses_database.db", echo=False)
-        Base.metadata.create_all(self.engine)
+HOUSE_IMAGES_DIR = "app/static/images_for_houses"
 
-        self.session_local = sessionmaker(bind=self.engine)
-        self.session = self.session_local()
 
-    def add_house(self, bedrooms, bathrooms, postcode, cost_pp_pw, date_added, date_avai_from, link, img_links):
-        self.session.query(Image).filter(Image.url == link).delete()
-        self.session.query(House).filter(House.url == link).delete()
+# a writer and a reader engine per process (see app/storage.py), each
+# thread gets its own session which is removed at the end of the request
+# (see create_app)
+engine, read_engine = sqlite_engines(Config.HOUSES_DATABASE_URL)
+Session = routing_session(engine, read_engine)
 
-        house = House(bedrooms=bedrooms, bathrooms=bathrooms, postal_code=postcode, price_pp_pw=cost_pp_pw,
-                      bills_inc=True, wifi_inc=True, washing_machine=True, url=link)
-        self.session.add(house)
-        self.session.commit()
-        self.session.refresh(house)
 
-        for url in img_links:
-            self.session.add(Image(house_id=house.id, url=url))
+class HouseRequests:
+    def __init__(self, session=None):
+        self.session = session or Session()
+
+    def add_house(self, bedrooms, bathrooms, postcode, cost_pp_pw, date_added, date_avai_from, link, img_links,
+                  listing_text=None):
+        return self.ingest_listings([{
+            'bedrooms': bedrooms,
+            'bathrooms': bathrooms,
+            'postal_code': postcode,
+            'price_pp_pw': cost_pp_pw,
+            'bills_inc': True,
+            'wifi_inc': True,
+            'washing_machine': True,
+            'url': link,
+            'listing_text': listing_text,
+            'images': img_links,
+        }])
+
+    def ingest_listings(self, listings, seen_at=None):
+        """
+        Inserts or updates a batch of scraped listings in one transaction,
+        matching them to stored houses by url. Each listing is a dict of
+        House columns plus "images", a list of image urls. Listings that
+        match what is stored are left alone, and images are only added or
+        removed where they differ. Every listing in the batch is marked as
+        seen at `seen_at` (default now).
+
+        Returns counts of inserted, updated and unchanged listings.
+        """
+        seen_at = seen_at or int(time.time())
+        # the same listing can show up on two result pages, keep the last
+        by_url = {listing['url']: listing for listing in listings}
+        urls = list(by_url)
+
+        stored = {}
+        stored_images = {}
+        for chunk in chunks(urls):
+            for house in self.session.query(House).filter(House.url.in_(chunk)):
+                stored[house.url] = house
+            for house_id, image_id, image_url in self.session.query(
+                    Image.house_id, Image.id, Image.url).join(
+                    House, House.id == Image.house_id).filter(House.url.in_(chunk)):
+                stored_images.setdefault(house_id, {})[image_url] = image_id
+
+        counts = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        changed_rows = []
+        for url, listing in by_url.items():
+            values = {column: value for column, value in listing.items()
+                      if column in LISTING_COLUMNS}
+            house = stored.get(url)
+            if house is None:
+                counts['inserted'] += 1
+                changed_rows.append(dict(values, first_seen=seen_at))
+            elif any(getattr(house, column) != value for column, value in values.items()):
+                counts['updated'] += 1
+                changed_rows.append(values)
+            elif set(listing.get('images', [])) != set(stored_images.get(house.id, {})):
+                counts['updated'] += 1
+            else:
+                counts['unchanged'] += 1
+
+        # upsert, so a listing inserted by someone else meanwhile is updated
+        house_ids = {url: house.id for url, house in stored.items()}
+        for columns, rows in group_by_columns(changed_rows).items():
+            for chunk in chunks(rows, 500):
+                statement = sqlite_insert(House).values(chunk)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[House.url],
+                    set_={column: statement.excluded[column] for column in columns
+                          if column not in ('url', 'first_seen')}
+                ).returning(House.id, House.url)
+                for house_id, url in self.session.execute(statement):
+                    house_ids[url] = house_id
+
+        # reconcile images by set difference instead of delete and reinsert
+        new_images = []
+        removed_image_ids = []
+        for url, listing in by_url.items():
+            if 'images' not in listing:
+                continue
+            house_id = house_ids[url]
+            have = stored_images.get(house_id, {})
+            wanted = list(dict.fromkeys(listing['images']))
+            new_images += [{'house_id': house_id, 'url': image_url}
+                           for image_url in wanted if image_url not in have]
+            removed_image_ids += [image_id for image_url, image_id in have.items()
+                                  if image_url not in wanted]
+
+        for chunk in chunks(removed_image_ids):
+            self.session.execute(delete(Image).where(Image.id.in_(chunk)))
+        if new_images:
+            self.session.execute(insert(Image), new_images)
+
+        relisted = self.__mark_seen(urls, seen_at)
+
+        if counts['inserted'] or counts['updated'] or relisted:
+            self.bump_catalog_version()
+        self.session.commit()
+        return counts
 
+    def mark_seen(self, urls, seen_at=None):
+        """
+        Records that the listings at these urls were scraped again without
+        changes. Returns how many of them had been delisted.
+        """
+        relisted = self.__mark_seen(urls, seen_at or int(time.time()))
+        if relisted:
+            self.bump_catalog_version()
         self.session.commit()
+        return relisted
+
+    def __mark_seen(self, urls, seen_at):
+        relisted = 0
+        for chunk in chunks(urls):
+            relisted += self.session.query(House).filter(
+                House.url.in_(chunk), House.delisted_at.isnot(None)).count()
+            self.session.execute(update(House).where(House.url.in_(chunk)).values(
+                last_seen=seen_at, delisted_at=None,
+                first_seen=func.coalesce(House.first_seen, seen_at)))
+        return relisted
+
+    def get_content_hashes(self, urls):
+        """
+        {url: content_hash} of the stored houses among these urls. Houses
+        still without a postcode or coordinates are left out, so they are
+        scraped (and geocoded) again.
+        """
+        hashes = {}
+        for chunk in chunks(urls):
+            hashes.update(self.session.query(House.url, House.content_hash).filter(
+                House.url.in_(chunk), House.postal_code.isnot(None),
+                House.x_coord.isnot(None), House.y_coord.isnot(None)).all())
+        return hashes
+
+    def delist_unseen(self, seen_before):
+        """
+        Marks houses last seen before `seen_before` as delisted, so they
+        drop out of searches. Returns how many were delisted.
+        """
+        # houses scraped before last_seen existed start their window now
+        self.session.execute(update(House).where(House.last_seen.is_(None)).values(
+            last_seen=int(time.time())))
+        delisted = self.session.execute(update(House).where(
+            House.last_seen < seen_before, House.delisted_at.is_(None)).values(
+            delisted_at=int(time.time()))).rowcount
+        if delisted:
+            self.bump_catalog_version()
+        self.session.commit()
+        return delisted
 
-    def update_area_for_all_houses(self):
+    def update_area_for_all_houses(self, offline=False):
         """
-        Updates the area field for all houses in the database.
+        Updates the area field for all houses in the database from their
+        postcodes, resolved in one batch. Houses whose area is unknown are
+        put in "Manchester". With offline=True only the local postcode data
+        is used. Returns the number of houses whose area changed.
         """
-        # Fetch all houses from the database
-        houses = self.session.query(House).all()
+        houses = self.session.query(House.id, House.postal_code, House.area).filter(
+            House.postal_code.isnot(None)).all()
+
+        areas = postcode_resolver.resolve_many(
+            [postal_code for _, postal_code, _ in houses], offline=offline)
+        postcode_resolver.save(self.session)
+
+        changed = [{'id': house_id, 'area': areas.get(postal_code) or "Manchester"}
+                   for house_id, postal_code, area in houses
+                   if (areas.get(postal_code) or "Manchester") != area]
+        if changed:
+            self.session.execute(update(House), changed)
+            self.bump_catalog_version()
+        self.session.commit()
+        return len(changed)
 
-        for house in houses:
-            if house.postal_code:  # Make sure the house has a postal code
-                area = get_manchester_area(house.postal_code)
-                if area!= None:
-                    house.area = area  # Update the area field
-                else:
-                    house.area = "Manchester"
-                print(f"Updated house ID {house.id} with area: {area}")
+    def bump_catalog_version(self):
+        """
+        Marks the houses table as changed so in-memory copies of it reload.
+        Committed together with the caller's changes.
+        """
+        updated = self.session.query(CatalogVersion).filter(
+            CatalogVersion.id == 1).update({CatalogVersion.version: CatalogVersion.version + 1})
+        if updated == 0:
+            self.session.add(CatalogVersion(id=1, version=1))
 
-        # Commit changes to the database
-        self.session.commit()
+    def get_catalog_version(self):
+        version = self.session.query(CatalogVersion.version).filter(
+            CatalogVersion.id == 1).scalar()
+        return version or 0
 
     @add_image
     @to_dict
     def get_all_houses(self, count):
-        return self.session.query(House).limit(count).all()
+        return self.session.query(House).filter(House.delisted_at.is_(None)).limit(count).all()
 
     @add_image
     @to_dict
@@ -105,26 +293,119 @@ class HouseRequests:
         value = self.session.query(House).filter(House.id.in_(ids)).all()
         return value
 
+    def search_houses(self, min_price=None, max_price=None, bedrooms=None,
+                      bathrooms=None, area=None, bills_inc=None, wifi_inc=None,
+                      max_minutes_to_uni=None, university_id=None,
+                      max_minutes_to_city_centre=None, transport="walking",
+                      query_text=None, sort="price-asc", cursor=None, limit=24):
+        """
+        Returns one page of houses matching the filters, ordered by `sort`.
+
+        Pagination is keyset based: pass the returned `next_cursor` back in
+        to get the page after it. `bedrooms`/`bathrooms` take a list of
+        counts where "4+" means four or more. The travel time filters use
+        the times precomputed by app.housingApi.commute.
+
+        `query_text` is matched against postcode, area and listing text, the
+        last word as a prefix. Sort by "relevance" to get the best matches
+        first.
+        """
+        if limit < 1:
+            raise ValueError(f"limit must be at least 1, not {limit}")
+        matches = None
+        if query_text:
+            match = build_match_query(query_text)
+            if match is None:
+                return {'houses': [], 'next_cursor': None}
+            matches = fts_matches(match)
+
+        if sort == "relevance":
+            if matches is None:
+                raise ValueError("Sorting by relevance needs query_text")
+            sort_column, descending = matches.c.rank, False
+        elif sort in SORT_OPTIONS:
+            column_name, descending = SORT_OPTIONS[sort]
+            sort_column = getattr(House, column_name)
+        else:
+            raise ValueError(f"Unknown sort option: {sort}")
+
+        query = self.session.query(House, sort_column).filter(
+            sort_column.isnot(None), House.delisted_at.is_(None))
+        if matches is not None:
+            query = query.join(matches, matches.c.house_id == House.id)
+
+        if min_price is not None:
+            query = query.filter(House.price_pp_pw >= min_price)
+        if max_price is not None:
+            query = query.filter(House.price_pp_pw <= max_price)
+        if bedrooms:
+            query = query.filter(count_filter(House.bedrooms, bedrooms))
+        if bathrooms:
+            query = query.filter(count_filter(House.bathrooms, bathrooms))
+        if area:
+            query = query.filter(House.area == area)
+        if bills_inc is not None:
+            query = query.filter(House.bills_inc == bills_inc)
+        if wifi_inc is not None:
+            query = query.filter(House.wifi_inc == wifi_inc)
+        if max_minutes_to_uni is not None:
+            if university_id is None:
+                raise ValueError("max_minutes_to_uni needs a university_id")
+            query = query.filter(within_minutes_of(
+                f"university:{university_id}", transport, max_minutes_to_uni))
+        if max_minutes_to_city_centre is not None:
+            query = query.filter(within_minutes_of(
+                "city_centre", transport, max_minutes_to_city_centre))
+
+        if cursor is not None:
+            last_value, last_id = decode_cursor(cursor)
+            key = tuple_(sort_column, House.id)
+            if descending:
+                query = query.filter(key < tuple_(last_value, last_id))
+            else:
+                query = query.filter(key > tuple_(last_value, last_id))
+
+        if descending:
+            query = query.order_by(sort_column.desc(), House.id.desc())
+        else:
+            query = query.order_by(sort_column.asc(), House.id.asc())
 
+        # fetch one extra row to find out whether there is another page
+        rows = query.limit(limit + 1).all()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            last_house, last_value = rows[-1]
+            next_cursor = encode_cursor(last_value, last_house.id)
+        houses = [house for house, _ in rows]
 
+        return {
+            'houses': self.__with_images(houses),
+            'next_cursor': next_cursor
+        }
+
+    @add_image
+    @to_dict
+    def __with_images(self, houses):
+        return houses
 
     @primary_key
     def get_houses_by_area_code(self, area_code):
-        return self.session.query(House).filter(House.postal_code.ilike(f"{area_code}%"))
+        return self.session.query(House.id).filter(postcode_prefix_filter(area_code))
 
     @primary_key
     def get_houses_by_price(self, lowest_first=True, area_code=""):
         if area_code == "":
             if lowest_first:
-                return self.session.query(House).order_by(House.price_pp_pw.asc())
+                return self.session.query(House.id).order_by(House.price_pp_pw.asc())
             else:
-                return self.session.query(House).order_by(House.price_pp_pw.desc())
+                return self.session.query(House.id).order_by(House.price_pp_pw.desc())
         else:
             if lowest_first:
-                return self.session.query(House).filter(House.postal_code.ilike(f"{area_code}%")).order_by(
+                return self.session.query(House.id).filter(postcode_prefix_filter(area_code)).order_by(
                     House.price_pp_pw.asc())
             else:
-                return self.session.query(House).filter(House.postal_code.ilike(f"{area_code}%")).order_by(
+                return self.session.query(House.id).filter(postcode_prefix_filter(area_code)).order_by(
                     House.price_pp_pw.desc())
 
     def get_all_postcodes(self):
@@ -146,9 +427,306 @@ class HouseRequests:
     @staticmethod
     @flaskify_images
     def get_images_for_house(house_id):
-        return os.listdir(f"app/static/images_for_houses/{house_id}")
+        return image_manifest.files_for_house(house_id)
+
+    def build_image_manifest(self, house_ids=None, images_dir=HOUSE_IMAGES_DIR):
+        """
+        Records the size and content hash of every file in
+        images_dir/<house id>/, so pages never have to list the directories.
+        Files whose size and modification time are unchanged are not hashed
+        again. Pass house_ids to only rescan those houses. The catalog
+        version is only bumped when a file was added, removed or has new
+        content, as every process reloads its catalog when it changes.
+        """
+        query = self.session.query(ImageFile)
+        if house_ids is not None:
+            query = query.filter(ImageFile.house_id.in_(house_ids))
+        existing = {(row.house_id, row.filename): row for row in query}
+
+        counts = {'added': 0, 'updated': 0, 'removed': 0, 'unchanged': 0}
+        changed = False
+        seen = set()
+        house_dirs = os.scandir(images_dir) if os.path.isdir(images_dir) else []
+        for house_dir in house_dirs:
+            if not house_dir.is_dir() or not house_dir.name.isdigit():
+                continue
+            house_id = int(house_dir.name)
+            if house_ids is not None and house_id not in house_ids:
+                continue
+
+            for file in os.scandir(house_dir.path):
+                if not file.is_file():
+                    continue
+                seen.add((house_id, file.name))
+                stat = file.stat()
+                row = existing.get((house_id, file.name))
+                if row is not None and row.size == stat.st_size and \
+                        row.modified == stat.st_mtime_ns:
+                    counts['unchanged'] += 1
+                    continue
+
+                if row is None:
+                    row = ImageFile(house_id=house_id, filename=file.name)
+                    self.session.add(row)
+                    counts['added'] += 1
+                else:
+                    counts['updated'] += 1
+                content_hash = hash_file(file.path)
+                # a touched file with the same content leaves the manifest as it was
+                changed = changed or content_hash != row.content_hash
+                row.size = stat.st_size
+                row.modified = stat.st_mtime_ns
+                row.content_hash = content_hash
+
+        for key, row in existing.items():
+            if key not in seen:
+                self.session.delete(row)
+                counts['removed'] += 1
+                changed = True
+
+        if changed:
+            self.bump_catalog_version()
+        self.session.commit()
+        return counts
+
+
+class CatalogCache(abc.ABC):
+    """
+    A value loaded from the houses database and kept in memory. It is
+    reloaded when the catalog version (see bump_catalog_version) changes,
+    which is checked at most once every refresh_interval seconds.
+    """
+
+    def __init__(self, refresh_interval=Config.HOUSE_CATALOG_REFRESH_INTERVAL):
+        self.refresh_interval = refresh_interval
+        self._value = None
+        self._version = None
+        self._last_check = 0
+        self._lock = threading.Lock()
+
+    @abc.abstractmethod
+    def load(self, session, version):
+        """Loads the value for catalog version `version` through session."""
+
+    def get(self):
+        if not self.__needs_check():
+            return self._value
+
+        with self._lock:
+            # another thread may have refreshed while we waited for the lock
+            if self.__needs_check():
+                house_requests = HouseRequests()
+                version = house_requests.get_catalog_version()
+                if self._value is None or version != self._version:
+                    self._value = self.load(house_requests.session, version)
+                    self._version = version
+                self._last_check = time.monotonic()
+        return self._value
+
+    def invalidate(self):
+        """Forces a version check on the next get."""
+        self._last_check = 0
+
+    def __needs_check(self):
+        return (self._value is None or
+                time.monotonic() - self._last_check >= self.refresh_interval)
+
+
+class ImageManifest(CatalogCache):
+    """In-memory copy of the image_files table."""
+
+    def files_for_house(self, house_id):
+        """[(filename, content hash)] of the house's images, by filename."""
+        return list(self.get().get(house_id, {}).items())
+
+    def content_hash(self, house_id, filename):
+        return self.get().get(house_id, {}).get(filename)
+
+    def load(self, session, version):
+        files = {}
+        for house_id, filename, content_hash in session.query(
+                ImageFile.house_id, ImageFile.filename,
+                ImageFile.content_hash).order_by(ImageFile.house_id, ImageFile.filename):
+            files.setdefault(house_id, {})[filename] = content_hash
+        return files
+
+
+image_manifest = ImageManifest()
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(65536), b''):
+            digest.update(block)
+    return digest.hexdigest()[:16]
+
+
+# House columns a scraped listing may set, see ingest_listings
+LISTING_COLUMNS = ('bedrooms', 'bathrooms', 'postal_code', 'price_pp_pw',
+                   'deposit_cost', 'bills_inc', 'wifi_inc', 'washing_machine',
+                   'date_available_from', 'date_added', 'url', 'listing_text',
+                   'x_coord', 'y_coord', 'area', 'content_hash')
+
+
+def group_by_columns(rows):
+    """Groups dicts by their keys, as a multi-row INSERT needs the same columns."""
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    return groups
+
+
+# sort option -> (House column, descending)
+SORT_OPTIONS = {
+    "price-asc": ("price_pp_pw", False),
+    "price-desc": ("price_pp_pw", True),
+    "bedrooms": ("bedrooms", True),
+    "bathrooms": ("bathrooms", True),
+}
+
+
+def count_filter(column, counts):
+    """
+    Builds a filter matching any of the given room counts, e.g. ["1", "4+"]
+    matches exactly one or at least four.
+    """
+    conditions = []
+    for count in counts:
+        count = str(count)
+        if count.endswith("+"):
+            conditions.append(column >= int(count[:-1]))
+        else:
+            conditions.append(column == int(count))
+    return or_(*conditions)
+
+
+def within_minutes_of(destination, transport, minutes):
+    """
+    Filter for houses whose precomputed travel time to the destination by
+    the named transport type is at most `minutes`.
+    """
+    house_ids = (select(TimeToPlace.house_id)
+                 .join(TransportType, TransportType.id == TimeToPlace.transport_type_id)
+                 .where(TimeToPlace.destination == destination,
+                        TransportType.name == transport,
+                        TimeToPlace.time_to_place <= minutes))
+    return House.id.in_(house_ids)
+
+
+# full text index over the houses table, kept in sync by triggers so every
+# write to houses (add_house, update_area_for_all_houses, ...) updates it
+HOUSES_FTS_SCHEMA = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS houses_fts USING fts5(
+        postal_code, area, listing_text,
+        content='houses', content_rowid='id', prefix='2 3')""",
+    """CREATE TRIGGER IF NOT EXISTS houses_fts_insert AFTER INSERT ON houses BEGIN
+        INSERT INTO houses_fts(rowid, postal_code, area, listing_text)
+        VALUES (new.id, new.postal_code, new.area, new.listing_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS houses_fts_delete AFTER DELETE ON houses BEGIN
+        INSERT INTO houses_fts(houses_fts, rowid, postal_code, area, listing_text)
+        VALUES ('delete', old.id, old.postal_code, old.area, old.listing_text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS houses_fts_update
+    AFTER UPDATE OF postal_code, area, listing_text ON houses BEGIN
+        INSERT INTO houses_fts(houses_fts, rowid, postal_code, area, listing_text)
+        VALUES ('delete', old.id, old.postal_code, old.area, old.listing_text);
+        INSERT INTO houses_fts(rowid, postal_code, area, listing_text)
+        VALUES (new.id, new.postal_code, new.area, new.listing_text);
+    END""",
+]
+
+# bm25 weights of the postal_code, area and listing_text columns
+FTS_WEIGHTS = (10.0, 5.0, 1.0)
+
+
+def build_match_query(query_text):
+    """
+    Turns what the user typed into an FTS5 query matching every word, the
+    last one as a prefix so results update while typing. Returns None when
+    there are no words to search for.
+    """
+    words = re.findall(r"\w+", query_text.lower())
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+def fts_matches(match):
+    """Subquery of (house_id, rank) for an FTS5 query, best match first."""
+    weights = ", ".join(str(weight) for weight in FTS_WEIGHTS)
+    return (text(f"SELECT rowid AS house_id, bm25(houses_fts, {weights}) AS rank "
+                 f"FROM houses_fts WHERE houses_fts MATCH :match")
+            .bindparams(match=match)
+            .columns(house_id=Integer, rank=Float)
+            .subquery('matches'))
+
+
+def postcode_prefix_filter(area_code):
+    """
+    Filter for postcodes starting with area_code, e.g. "M14" or "M14 5",
+    answered from the full text index instead of scanning with LIKE.
+    """
+    words = re.findall(r"\w+", area_code.lower())
+    if not words:
+        return House.id.isnot(None)
+    match = 'postal_code : ^"' + " ".join(words) + '"*'
+    return House.id.in_(select(fts_matches(match).c.house_id))
+
+
+def encode_cursor(value, house_id):
+    return base64.urlsafe_b64encode(json.dumps([value, house_id]).encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        value, house_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor")
+    return value, house_id
+
+
+def create_house_database(engine=engine):
+    Base.metadata.create_all(engine)
+    add_missing_columns(engine)
+    # create_all skips the indexes of tables that already exist
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(engine, checkfirst=True)
+    create_search_index(engine)
+
+
+def create_search_index(engine):
+    with engine.begin() as connection:
+        exists = connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'houses_fts'")).first()
+        for statement in HOUSES_FTS_SCHEMA:
+            connection.execute(text(statement))
+        if not exists:
+            # index the houses added before the index existed
+            connection.execute(text(
+                "INSERT INTO houses_fts(houses_fts) VALUES ('rebuild')"))
+
+
+def add_missing_columns(engine):
+    """
+    Adds columns declared on the models but missing from tables created by
+    an older version, as create_all only creates whole tables.
+    """
+    with engine.begin() as connection:
+        # on the same connection, the writer engine only has the one
+        inspector = inspect(connection)
+        for table in Base.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(engine.dialect)
+                    connection.execute(text(
+                        f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
 
-    
 
 Base = declarative_base()
 
@@ -162,8 +740,9 @@ class House(Base):
     bathrooms = Column(Integer)
 
     postal_code = Column(String)
-    x_coord = Column(Integer)
-    y_coord = Column(Integer)
+    # longitude and latitude
+    x_coord = Column(Float)
+    y_coord = Column(Float)
 
     price_pp_pw = Column(Integer)
     deposit_cost = Column(Integer)
@@ -182,6 +761,26 @@ class House(Base):
 
     url = Column(String)
     area= Column(String)
+    # text of the listing as scraped, for full text search
+    listing_text = Column(String)
+
+    # hash of the scraped listing, see scraper.listing_fingerprint
+    content_hash = Column(String)
+    # seconds since the epoch
+    first_seen = Column(Integer)
+    last_seen = Column(Integer)
+    # set when the listing has not been seen for Config.LISTING_DELIST_AFTER
+    delisted_at = Column(Integer)
+
+    # support the filters and keyset sorts used by search_houses
+    __table_args__ = (
+        Index('ix_houses_url', 'url', unique=True),
+        Index('ix_houses_price_pp_pw', 'price_pp_pw'),
+        Index('ix_houses_bedrooms', 'bedrooms'),
+        Index('ix_houses_bathrooms', 'bathrooms'),
+        Index('ix_houses_area_price', 'area', 'price_pp_pw'),
+        Index('ix_houses_last_seen', 'last_seen'),
+    )
 
     def to_dict(self):
         return {
@@ -217,6 +816,57 @@ class Image(Base):
     house_id = Column(Integer, ForeignKey('houses.id'))
     url = Column(String)
 
+    # lets get_cover_images find the first image of each house from the index
+    __table_args__ = (
+        Index('ix_images_house_id', 'house_id', 'id'),
+    )
+
+
+# Files in app/static/images_for_houses, see build_image_manifest
+class ImageFile(Base):
+    __tablename__ = 'image_files'
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    house_id = Column(Integer, ForeignKey('houses.id'), nullable=False)
+    filename = Column(String, nullable=False)
+    size = Column(Integer)
+    modified = Column(Integer)  # nanoseconds since the epoch
+    content_hash = Column(String)
+
+    __table_args__ = (
+        Index('ix_image_files_house_id_filename', 'house_id', 'filename', unique=True),
+    )
+
+
+# Single row counting changes to the houses table, see bump_catalog_version
+class CatalogVersion(Base):
+    __tablename__ = 'catalog_version'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# wards postcodes.io gave, see app.housingApi.postcode_function
+class PostcodeWard(Base):
+    __tablename__ = 'postcode_wards'
+
+    postcode = Column(String, primary_key=True)  # "M14 5RQ"
+    ward = Column(String)  # None when postcodes.io doesn't know the postcode
+    fetched_at = Column(Integer, nullable=False)  # seconds since the epoch
+
+
+# Geocoder answers by place, see app.housingApi.geocode
+class GeocodeResult(Base):
+    __tablename__ = 'geocode_cache'
+
+    # normalized "area, city"
+    place = Column(String, primary_key=True)
+    found = Column(Boolean, nullable=False)
+    postcode = Column(String)
+    lat = Column(Float)
+    lon = Column(Float)
+    fetched_at = Column(Integer, nullable=False)  # seconds since the epoch
+
 
 # Transport type
 class TransportType(Base):
@@ -234,11 +884,26 @@ class TimeToPlace(Base):
     house_id = Column(Integer, ForeignKey('houses.id'))
     transport_type_id = Column(Integer, ForeignKey('transport_types.id'))
     time_to_place = Column(Integer)  # Stored in minutes
+    # "city_centre" or "university:<universityID>"
+    destination = Column(String)
+    # destination coordinates the time was computed from, to spot moved universities
+    destination_lat = Column(Float)
+    destination_long = Column(Float)
+    # house coordinates the time was computed from, to spot moved houses
+    origin_x = Column(Float)
+    origin_y = Column(Float)
+
+    __table_args__ = (
+        # answers within_minutes_of from the index alone
+        Index('ix_time_to_place_lookup', 'destination', 'transport_type_id',
+              'time_to_place', 'house_id'),
+        Index('ix_time_to_place_house_id', 'house_id'),
+    )
 
 
 if __name__ == "__main__":
     engine = create_engine("sqlite:///houses_database.db", echo=False)
-    Base.metadata.create_all(engine)
+    create_house_database(engine)
 
     session_local = sessionmaker(bind=engine)
     session = session_local()
@@ -0,0 +1,159 @@
+"""
+Small asyncio pipeline: stages connected by bounded queues, each with its
+own number of workers.
+
+A stage's handler takes one item and returns the items to pass on to the
+next stage (any number of them); a stage with a batch_size takes lists of
+up to that many items instead. Blocking handlers should hand their work
+to asyncio.to_thread so they don't hold up the other stages. A full queue
+makes the stage before it wait, so a slow stage slows the pipeline down
+instead of piling up work in memory.
+
+An item whose handler raises is written to the dead-letter file with the
+stage and the error, and the pipeline carries on; when a batch handler
+raises, every item of the batch is. The file can be fed back in with
+Pipeline.replay.
+"""
+import asyncio
+import json
+import time
+import traceback
+
+# marks the end of the items in a queue
+_DONE = object()
+
+
+class Stage:
+    """
+    One step of a Pipeline. With a batch_size the handler is given lists of
+    that many items, and the rest of the items once the last has arrived,
+    for stages that work in batches.
+    """
+
+    def __init__(self, name, handler, concurrency=1, queue_size=100, batch_size=None):
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.stats = {'in': 0, 'out': 0, 'failed': 0, 'busy_seconds': 0.0}
+
+
+class Pipeline:
+    def __init__(self, stages, dead_letter_path=None):
+        self.stages = stages
+        self.dead_letter_path = dead_letter_path
+        self.dead_letters = 0
+
+    async def run(self, items, start=None):
+        """
+        Passes items through the stages, beginning at the stage named
+        `start` (the first one by default), and waits until all are done.
+        """
+        stages = self.stages
+        if start is not None:
+            stages = stages[[stage.name for stage in stages].index(start):]
+
+        queues = [asyncio.Queue(maxsize=stage.queue_size) for stage in stages]
+        tasks = [asyncio.create_task(self.__run_stage(stage, queue, next_queue, next_stage))
+                 for stage, queue, next_queue, next_stage in
+                 zip(stages, queues, queues[1:] + [None], stages[1:] + [None])]
+
+        for item in items:
+            await queues[0].put(item)
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(_DONE)
+
+        await asyncio.gather(*tasks)
+
+    async def replay(self, path):
+        """Runs the items of a dead-letter file again, each from the stage it failed in."""
+        by_stage = {}
+        with open(path) as file:
+            for line in file:
+                letter = json.loads(line)
+                if letter.get('item') is None:
+                    print(f"Skipping a dead letter of {letter.get('stage')} without an item")
+                    continue
+                by_stage.setdefault(letter['stage'], []).append(letter['item'])
+        for stage in self.stages:
+            if stage.name in by_stage:
+                await self.run(by_stage[stage.name], start=stage.name)
+
+    def report(self):
+        lines = [f"{'stage':<10}{'in':>7}{'out':>7}{'failed':>8}{'busy s':>9}{'items/s':>10}"]
+        for stage in self.stages:
+            stats = stage.stats
+            rate = stats['in'] / stats['busy_seconds'] if stats['busy_seconds'] else 0
+            lines.append(f"{stage.name:<10}{stats['in']:>7}{stats['out']:>7}"
+                         f"{stats['failed']:>8}{stats['busy_seconds']:>9.2f}{rate:>10.1f}")
+        if self.dead_letters:
+            lines.append(f"{self.dead_letters} failed items written to {self.dead_letter_path}")
+        return "\n".join(lines)
+
+    async def __run_stage(self, stage, queue, next_queue, next_stage):
+        async def emit(results):
+            for result in results or ():
+                stage.stats['out'] += 1
+                if next_queue is not None:
+                    await next_queue.put(result)
+
+        async def handle(work, items):
+            started = time.perf_counter()
+            try:
+                results = await stage.handler(work)
+            except Exception as e:
+                for item in items:
+                    self.dead_letter(stage.name, item, e)
+                return
+            finally:
+                stage.stats['busy_seconds'] += time.perf_counter() - started
+            await emit(results)
+
+        # shared by the stage's workers
+        batch = []
+
+        async def worker():
+            nonlocal batch
+            while True:
+                item = await queue.get()
+                if item is _DONE:
+                    return
+                stage.stats['in'] += 1
+                if stage.batch_size is None:
+                    await handle(item, [item])
+                    continue
+                batch.append(item)
+                if len(batch) >= stage.batch_size:
+                    full, batch = batch, []
+                    await handle(full, full)
+
+        await asyncio.gather(*(worker() for _ in range(stage.concurrency)))
+        if batch:
+            rest, batch = batch, []
+            await handle(rest, rest)
+        if next_queue is not None:
+            for _ in range(next_stage.concurrency):
+                await next_queue.put(_DONE)
+
+    def dead_letter(self, stage_name, item, error):
+        """
+        Appends a failed item to the dead-letter file, or prints it if there
+        is none. Handlers can call it for parts of an item that failed.
+        """
+        self.dead_letters += 1
+        for stage in self.stages:
+            if stage.name == stage_name:
+                stage.stats['failed'] += 1
+        letter = {
+            'stage': stage_name,
+            'item': item,
+            'error': repr(error),
+            'traceback': traceback.format_exception(error),
+            'failed_at': int(time.time()),
+        }
+        if self.dead_letter_path is None:
+            print(f"{stage_name} failed: {error!r}")
+            return
+        with open(self.dead_letter_path, 'a') as file:
+            file.write(json.dumps(letter, default=str) + "\n")
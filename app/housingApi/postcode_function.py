@@ -1,7 +1,29 @@
+import csv
+import os.path
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import requests
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.config import Config
+from app.storage import chunks
+
+# postcode,ward rows shipped with the app, looked up before asking
+# postcodes.io; never written to, what postcodes.io gives goes in the
+# postcode_wards table
+POSTCODE_WARDS_CSV = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                  "data", "postcode_wards.csv")
 
+POSTCODES_IO_URL = "https://api.postcodes.io/postcodes"
+# most postcodes one bulk request to postcodes.io may contain
+POSTCODES_IO_BATCH_SIZE = 100
 
+UK_POSTCODE = re.compile(r'^([A-Z]{1,2}[0-9][A-Z0-9]?)([0-9][A-Z]{2})$')
 
+# Areas by outward code, used when a postcode's ward is not known
 custom_ward_mapping = {
     "M1": "City Centre",
     "M2": "Spinningfields",
@@ -63,46 +85,196 @@ custom_ward_mapping = {
     "M59": "Manchester North East",
     # More postcodes can be added here
 }
-import requests
 
-# Example dictionary for Manchester postcodes to wards (you can expand this with actual data)
 
+def split_postcode(postcode):
+    """(outward, inward) code of a postcode, or None if it isn't one."""
+    match = UK_POSTCODE.match(postcode.replace(" ", "").upper())
+    return match.groups() if match else None
 
 
-def get_manchester_area(postcode):
+class PostcodeAreaResolver:
     """
-    Takes a UK postcode and returns the corresponding area in Manchester
-    using the Postcodes.io API if not found in the custom dictionary.
+    Resolves postcodes to wards from an in-memory index of a postcode/ward
+    CSV, keyed by outward then inward code. Postcodes that are not in it
+    are looked up on postcodes.io in bulk requests and remembered, and
+    save() stores the answers in the postcode_wards table, which is read
+    on first use, so the next run needs no network. That includes the
+    postcodes postcodes.io doesn't know, which are only asked about again
+    after not_found_ttl seconds.
     """
-    postcode = postcode.replace(" ", "").upper()  # Normalize postcode
 
-    # Check if postcode is already in the dictionary
-    if postcode in custom_ward_mapping:
-        return custom_ward_mapping[postcode]
+    def __init__(self, path=POSTCODE_WARDS_CSV, workers=4, timeout=10,
+                 not_found_ttl=Config.POSTCODE_NOT_FOUND_TTL):
+        self.path = path
+        self.workers = workers
+        self.timeout = timeout
+        self.not_found_ttl = not_found_ttl
+        self.wards = {}  # outward -> {inward: ward}
+        self.not_found = {}  # (outward, inward) -> when postcodes.io didn't know it
+        self.unsaved = {}  # (outward, inward) -> ward, None if not found
+        self._stored_loaded = False
+        self._lock = threading.Lock()
+
+        if os.path.exists(path):
+            with open(path, newline="") as file:
+                for row in csv.DictReader(file):
+                    codes = split_postcode(row["postcode"])
+                    if codes and row["ward"]:
+                        self.__add(codes, row["ward"])
+
+    def __len__(self):
+        return sum(len(inward) for inward in self.wards.values())
+
+    def resolve_many(self, postcodes, offline=False):
+        """
+        {postcode: area} for every postcode. A postcode without a known
+        ward gets the area of its outward code from custom_ward_mapping, or
+        None. With offline=True postcodes.io is not asked.
+        """
+        codes = {postcode: split_postcode(postcode) for postcode in set(postcodes) if postcode}
+        self.__load_stored()
+
+        missing = {postcode_codes for postcode_codes in codes.values()
+                   if postcode_codes and self.__ward(postcode_codes) is None and
+                   not self.__known_missing(postcode_codes)}
+        if missing and not offline:
+            self.__fetch(sorted(missing))
+
+        areas = {}
+        for postcode, postcode_codes in codes.items():
+            if postcode_codes is None:
+                areas[postcode] = None
+            else:
+                areas[postcode] = self.__ward(postcode_codes) or \
+                    custom_ward_mapping.get(postcode_codes[0])
+        return areas
+
+    def resolve(self, postcode, offline=False):
+        return self.resolve_many([postcode], offline).get(postcode)
 
-    # If not found in the dictionary, make an API request
-    url = f"https://api.postcodes.io/postcodes/{postcode}"
+    def save(self, session=None):
+        """
+        Stores what postcodes.io answered since the last save in the
+        postcode_wards table, committing session (a new houses database
+        session by default). Returns the number of postcodes stored.
+        """
+        # imported here as main imports this module
+        from app.housingApi.main import PostcodeWard, Session
 
-    try:
-        response = requests.get(url)
-        data = response.json()
+        with self._lock:
+            unsaved, self.unsaved = self.unsaved, {}
+        if not unsaved:
+            return 0
+        fetched_at = int(time.time())
+        rows = [{'postcode': f"{outward} {inward}", 'ward': ward, 'fetched_at': fetched_at}
+                for (outward, inward), ward in sorted(unsaved.items())]
 
-        # Check if "result" exists in API response
-        if response.status_code == 200 and data.get("result"):
-            district = data["result"].get("admin_district", "Unknown District")
-            ward = data["result"].get("admin_ward", "Unknown Ward")
+        own_session = session is None
+        session = session or Session.session_factory()
+        try:
+            for chunk in chunks(rows):
+                statement = sqlite_insert(PostcodeWard).values(chunk)
+                statement = statement.on_conflict_do_update(
+                    index_elements=[PostcodeWard.postcode],
+                    set_={column: statement.excluded[column]
+                          for column in ('ward', 'fetched_at')})
+                session.execute(statement)
+            session.commit()
+        finally:
+            if own_session:
+                session.close()
+        return len(rows)
 
-            # Return ward from API response
-            return f"{ward}"
+    def __ward(self, codes):
+        outward, inward = codes
+        return self.wards.get(outward, {}).get(inward)
 
-        elif response.status_code == 404:
-            return "Invalid postcode"
-        else:
-            return "Unknown area (API response error)"
+    def __add(self, codes, ward):
+        outward, inward = codes
+        self.wards.setdefault(outward, {})[inward] = ward
 
-    except requests.exceptions.RequestException as e:
-        return f"Network error: {str(e)}"
+    def __known_missing(self, codes):
+        not_found_at = self.not_found.get(codes)
+        return not_found_at is not None and time.time() - not_found_at < self.not_found_ttl
 
+    def __load_stored(self):
+        """Reads the postcode_wards table the first time a postcode is resolved."""
+        if self._stored_loaded:
+            return
+        # imported here as main imports this module
+        from app.housingApi.main import PostcodeWard, Session
+
+        with self._lock:
+            if self._stored_loaded:
+                return
+            with Session.session_factory() as session:
+                for postcode, ward, fetched_at in session.query(
+                        PostcodeWard.postcode, PostcodeWard.ward, PostcodeWard.fetched_at):
+                    codes = split_postcode(postcode)
+                    if codes is None:
+                        continue
+                    if ward:
+                        self.__add(codes, ward)
+                    else:
+                        self.not_found[codes] = fetched_at
+            self._stored_loaded = True
+
+    def __fetch(self, missing):
+        batches = [missing[start:start + POSTCODES_IO_BATCH_SIZE]
+                   for start in range(0, len(missing), POSTCODES_IO_BATCH_SIZE)]
+        with requests.Session() as http, \
+                ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for batch, results in zip(batches, executor.map(
+                    lambda batch: self.__fetch_batch(http, batch), batches)):
+                if results is None:
+                    # the request failed, so try these postcodes again next time
+                    continue
+                now = time.time()
+                with self._lock:
+                    for codes, ward in zip(batch, results):
+                        if ward:
+                            self.__add(codes, ward)
+                        else:
+                            self.not_found[codes] = now
+                        self.unsaved[codes] = ward
+
+    def __fetch_batch(self, http, batch):
+        """
+        Wards of a batch of (outward, inward) codes, None where postcodes.io
+        doesn't know the postcode. None if the request failed.
+        """
+        try:
+            response = http.post(POSTCODES_IO_URL, timeout=self.timeout, json={
+                "postcodes": [outward + inward for outward, inward in batch]})
+            response.raise_for_status()
+            results = response.json()["result"]
+        except (requests.RequestException, ValueError, KeyError) as e:
+            print(f"postcodes.io lookup failed: {e}")
+            return None
+        return [(item.get("result") or {}).get("admin_ward") for item in results]
+
+
+resolver = PostcodeAreaResolver()
+
+
+def get_manchester_area(postcode):
+    """
+    Takes a UK postcode and returns the corresponding area in Manchester,
+    or None if it isn't known.
+    """
+    return resolver.resolve(postcode)
 
 
+if __name__ == "__main__":
+    # Benchmark: resolving every postcode in the CSV, from memory
+    from app.housingApi.main import create_house_database
 
+    create_house_database()
+    postcodes = [f"{outward} {inward}" for outward, inwards in resolver.wards.items()
+                 for inward in inwards]
+    start = time.perf_counter()
+    for _ in range(100):
+        resolver.resolve_many(postcodes, offline=True)
+    elapsed = (time.perf_counter() - start) / 100
+    print(f"{len(postcodes)} postcodes resolved in {elapsed * 1000:.2f} ms")
@@ -1,130 +1,356 @@
-from playwright.sync_api import sync_playwright
-import requests
-from main import HouseRequests
-import re
-import datetime
+import asyncio
+import contextlib
+import hashlib
+import json
+import os.path
+import time
+from urllib.parse import urlparse, parse_qs
 
+from playwright.async_api import async_playwright, Error as PlaywrightError
+from app.config import Config
+from app.housingApi.main import HouseRequests, Session, create_house_database
+from app.housingApi.geocode import Geocoder, RateLimiter
+from app.housingApi.pipeline import Pipeline, Stage
+from app.housingApi.listing_parser import parse_listing
+from app.housingApi.postcode_function import resolver as postcode_resolver
 
-def scrape_property_listings():
-    house_listings = []
-    with sync_playwright() as p:
-        for page in range(1, 19):  # modify upper boundary to number of pages on website
-            url = "https://www.unihomes.co.uk/student-accommodation/manchester" + f"?page={page}"
-            # Launch the browser (WebKit for Safari)
-            browser = p.webkit.launch(headless=False)
-            page = browser.new_page()
+RESULTS_URL = "https://www.unihomes.co.uk/student-accommodation/manchester"
+RESULT_PAGES = range(1, 19)  # modify upper boundary to number of pages on website
+CITY = "Manchester, United Kingdom"
 
-            # Navigate to the target URL
-            page.goto(url)
+LISTINGS_CONTAINER = '.col-12.properties_listing_container'
+LISTING_SELECTOR = f'{LISTINGS_CONTAINER} .col-12.col-sm-6.col-xl-4.property-listing-column'
 
-            # Wait for the container with all listings to load
-            page.wait_for_selector('.col-12.properties_listing_container')
+# saved results pages (page-<number>.html) for scraping without the network
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+# listings that failed a stage of the scrape, see replay_dead_letters
+DEAD_LETTER_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "scrape_dead_letters.jsonl")
+
+# workers per stage of a ScrapeRun
+STAGE_CONCURRENCY = {'fetch': 4, 'parse': 1, 'geocode': 1, 'area': 2}
+
+# runs in the browser, returns the text, link and images of every listing
+EXTRACT_LISTINGS_JS = """
+listings => listings.map(listing => ({
+    text: listing.innerText,
+    link: listing.querySelector('a') ? listing.querySelector('a').getAttribute('href') : null,
+    images: Array.from(listing.querySelectorAll('.swiper-wrapper img'))
+        .map(img => img.getAttribute('src'))
+        .filter(src => src && !src.startsWith('data'))
+}))
+"""
+
+
+def scrape_property_listings(pool_size=4, fixture_dir=None, concurrency=None,
+                             batch_size=50, dead_letter_path=DEAD_LETTER_FILE):
+    """
+    Scrapes every results page and stores the new and changed listings.
+    Listings whose fingerprint matches the stored one are only marked as
+    seen, without geocoding or rewriting them, and listings not seen for
+    Config.LISTING_DELIST_AFTER are delisted. Pass fixture_dir to scrape
+    saved pages instead of the live site.
+
+    The work runs as a ScrapeRun pipeline; `concurrency` overrides the
+    workers per stage in STAGE_CONCURRENCY, pool_size sets those of the
+    fetch stage. Returns a summary of the changes made by the run.
+    """
+    concurrency = dict(STAGE_CONCURRENCY, fetch=pool_size, **(concurrency or {}))
+    run = ScrapeRun(concurrency, batch_size, dead_letter_path, fixture_dir)
+    return asyncio.run(run.run(RESULT_PAGES))
+
+
+def replay_dead_letters(path=DEAD_LETTER_FILE, fixture_dir=None):
+    """
+    Runs the items of a dead-letter file through the pipeline again, each
+    from the stage it failed in. Items that fail again go to a new file.
+    Returns the run's summary, or None when there is no file to replay.
+    """
+    replayed = f"{path}.replayed"
+    try:
+        os.replace(path, replayed)
+    except FileNotFoundError:
+        print(f"No dead letters to replay at {path}")
+        return None
+    run = ScrapeRun(STAGE_CONCURRENCY, 50, path, fixture_dir)
+    return asyncio.run(run.run(replay_path=replayed))
+
+
+class ScrapeRun:
+    """
+    One scrape as a pipeline of fetch, parse, geocode, area and write
+    stages, see app.housingApi.pipeline. Blocking work runs in threads, so
+    slow geocoding or writes only slow the browser down once the queues
+    between the stages are full.
+    """
+
+    def __init__(self, concurrency, batch_size, dead_letter_path, fixture_dir=None):
+        self.started = int(time.time())
+        self.fixture_dir = fixture_dir
+        self.summary = {'listings': 0, 'unparsed': 0, 'inserted': 0, 'updated': 0,
+                        'unchanged': 0, 'delisted': 0, 'geocoded': 0}
+        self.unchanged_urls = set()
+        self.locations = {}
+        self.writer = HouseRequests(Session.session_factory())
+
+        # geocoders share the rate limit but each has its own DB session
+        self.rate_limiter = RateLimiter(Config.GEOCODER_REQUESTS_PER_SECOND)
+        self.geocoders = asyncio.Queue()
+        for _ in range(concurrency['geocode']):
+            self.geocoders.put_nowait(Geocoder(Session.session_factory(),
+                                               rate_limiter=self.rate_limiter))
+
+        self.pipeline = Pipeline([
+            Stage('fetch', self.fetch, concurrency['fetch'], queue_size=4),
+            Stage('parse', self.parse, concurrency['parse'], queue_size=4),
+            Stage('geocode', self.geocode, concurrency['geocode']),
+            Stage('area', self.add_areas, concurrency['area'], batch_size=batch_size),
+            Stage('write', self.write, 1, batch_size=batch_size),
+        ], dead_letter_path)
+
+    async def run(self, page_numbers=(), replay_path=None):
+        async with browser_pages(self.pipeline.stages[0].concurrency,
+                                 fixture_dir=self.fixture_dir) as pages:
+            self.pages = pages
+            if replay_path is None:
+                await self.pipeline.run(page_numbers)
+            else:
+                await self.pipeline.replay(replay_path)
+
+        await asyncio.to_thread(self.finish, replay_path is None)
+        print(self.pipeline.report())
+        print(f"Scrape finished: {self.summary}")
+        return self.summary
 
-            # Query all individual listings inside the container
-            listings = page.query_selector_all(
-                '.col-12.properties_listing_container .col-12.col-sm-6.col-xl-4.property-listing-column')
+    def finish(self, complete):
+        self.writer.mark_seen(self.unchanged_urls, self.started)
+        self.summary['unchanged'] = len(self.unchanged_urls)
+        # a replay only covers part of the listings, so nothing is delisted
+        if complete:
+            self.summary['delisted'] = self.writer.delist_unseen(
+                self.started - Config.LISTING_DELIST_AFTER)
+        postcode_resolver.save(self.writer.session)
+        while not self.geocoders.empty():
+            geocoder = self.geocoders.get_nowait()
+            geocoder.session.close()
+        self.writer.session.close()
 
-            for listing in listings:
-                address = listing.inner_text().replace("\n", " ").replace("Featured", "").replace("Bills Included",
-                                                                                                  "").strip()  # This will get the full text of the listing
+    async def fetch(self, page_number):
+        page = await self.pages.get()
+        try:
+            return await fetch_result_page(page, page_number)
+        finally:
+            self.pages.put_nowait(page)
 
-                link = listing.query_selector('a').get_attribute("href")
-                img = page.query_selector_all('.aspect-ratio-airbnb.swiper-slide.swiper-slide-active')
+    async def parse(self, raw_listings):
+        """Parses a results page, passing on the listings that changed."""
+        listings = []
+        for raw_listing in raw_listings:
+            self.summary['listings'] += 1
+            try:
+                listing = split_listing(raw_listing['text'], raw_listing['link'],
+                                        raw_listing['images'])
+            except Exception as e:
+                self.summary['unparsed'] += 1
+                self.pipeline.dead_letter('parse', [raw_listing], e)
+                continue
+            listing['content_hash'] = listing_fingerprint(listing)
+            listings.append(listing)
 
-                # new code
-                swiper_wrapper = page.query_selector('.swiper-wrapper')
-                image_elements = swiper_wrapper.query_selector_all('img')
-                image_links = []
-                for img in image_elements:
-                    src = img.get_attribute('src')
-                    if src:
-                        if src[0:4] != "data":
-                            image_links.append(src)
+        stored_hashes = await asyncio.to_thread(
+            stored_content_hashes, [listing['url'] for listing in listings])
+        changed = []
+        for listing in listings:
+            if stored_hashes.get(listing['url']) == listing['content_hash']:
+                self.unchanged_urls.add(listing['url'])
+            else:
+                changed.append(listing)
+        return changed
 
+    async def geocode(self, listing):
+        # listings on the same road share one lookup, even when in flight
+        road_area = listing['road_area']
+        if road_area not in self.locations:
+            self.locations[road_area] = asyncio.ensure_future(self.resolve(road_area))
+        location = await self.locations[road_area]
+        if location is not None:
+            listing['postal_code'] = location['postcode']
+            listing['x_coord'] = location['lon']
+            listing['y_coord'] = location['lat']
+        if not is_geocoded(listing):
+            # without a fingerprint the next scrape treats it as changed
+            # and tries the lookup again
+            listing['content_hash'] = None
+        return [listing]
+
+    async def resolve(self, road_area):
+        geocoder = await self.geocoders.get()
+        try:
+            location = await asyncio.to_thread(geocoder.resolve, road_area, CITY)
+        finally:
+            self.geocoders.put_nowait(geocoder)
+        if is_geocoded(location or {}, 'postcode', 'lon', 'lat'):
+            self.summary['geocoded'] += 1
+        return location
+
+    async def add_areas(self, batch):
+        """Looks up the areas of a batch's distinct postcodes at once, passes the batch on."""
+        postcodes = {listing['postal_code'] for listing in batch if listing.get('postal_code')}
+        if postcodes:
+            # if this fails the pipeline dead-letters the whole batch
+            areas = await asyncio.to_thread(postcode_resolver.resolve_many, postcodes)
+            for listing in batch:
+                if listing.get('postal_code'):
+                    listing['area'] = areas.get(listing['postal_code']) or "Manchester"
+        return batch
+
+    async def write(self, batch):
+        await asyncio.to_thread(self.write_batch, batch)
+
+    def write_batch(self, batch):
+        """
+        Stores a batch in one transaction. If that fails the listings are
+        stored one by one, so only the ones at fault are dead-lettered.
+        """
+        try:
+            counts = self.writer.ingest_listings(batch, self.started)
+        except Exception:
+            self.writer.session.rollback()
+            if len(batch) == 1:
+                raise
+            for listing in batch:
                 try:
-                    split_listing(address, link, image_links)
-                except:
-                    pass
+                    self.write_batch([listing])
+                except Exception as e:
+                    self.pipeline.dead_letter('write', listing, e)
+            return
+        for name, count in counts.items():
+            self.summary[name] += count
 
-                house_listings.append(address)
 
-            # Print the result (all listings in an array)
-        for house in house_listings:
-            # print(house)
-            pass
-            # Close the browser
-        browser.close()
+def stored_content_hashes(urls):
+    with Session.session_factory() as session:
+        return HouseRequests(session).get_content_hashes(urls)
 
 
-def split_listing(listing, link, img_link):
-    bathrooms_split = listing.split(" bathrooms")
-    bathrooms_number = bathrooms_split[0].strip()  # no of bathrooms
-    bedrooms_split = bathrooms_split[1].split(" Bedroom")
-    bedrooms_number = bedrooms_split[0].strip()  # number of bedrooms
-    new_arr = bedrooms_split[1]
-    if "House" in new_arr:
-        new_arr = new_arr.split("House")
-    else:
-        new_arr = new_arr.split("Apartment")
-    new_arr = new_arr[1].strip()
-    road = new_arr.split(",")
-    date_avai_from = road[-1].split("from ")[1]  # date available from
-    road_area = road[0]
-    road = road[1]
-    road = road.split("£")
-    road = road[1].split("per")
-    cost_pw = road[0].strip()  # cost pw
-    added = road[-1].split(" ")[-1]  # date added
-    postcode = get_postcode("Manchester, United Kingdom", road_area)
-    print(f"Property has {bedrooms_number} bedrooms, {bathrooms_number} bathrooms, is in {road_area}, costs £{cost_pw} per week, was added {added} and is available from {date_avai_from}, postcode is {postcode}, link is {link}, image link is {img_link}")
-
-    add_to_database(bedrooms_number, bathrooms_number, postcode, cost_pw, added, date_avai_from, link, img_link)
+def is_geocoded(listing, *columns):
+    """Whether the listing has a postcode and coordinates."""
+    return all(listing.get(column) is not None
+               for column in columns or ('postal_code', 'x_coord', 'y_coord'))
 
 
-def get_postcode(city, area):
-    url = "https://nominatim.openstreetmap.org/search"
+def listing_fingerprint(listing):
+    """
+    Hash of what split_listing read from a listing, to tell whether it
+    changed since the last scrape.
+    """
+    content = json.dumps(listing, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(content.encode('utf8')).hexdigest()[:16]
 
-    params = {
-        'q': f'{area}, {city}',
-        'format': 'json',
-        'addressdetails': 1
-    }
 
-    headers = {
-        'User-Agent': 'YourAppName/1.0 (your_email@example.com)'
-    }
+@contextlib.asynccontextmanager
+async def browser_pages(pool_size=4, timeout=30, fixture_dir=None):
+    """
+    Opens one headless browser and yields a queue of pool_size pages to
+    take and put back, so pages are reused between results pages.
+    """
+    async with async_playwright() as p:
+        browser = await p.webkit.launch(headless=True)
+        try:
+            context = await browser.new_context()
+            context.set_default_timeout(timeout * 1000)
+            if fixture_dir is not None:
+                await context.route("**/*", fixture_handler(fixture_dir))
 
-    response = requests.get(url, params=params, headers=headers)
+            pages = asyncio.Queue()
+            for _ in range(pool_size):
+                pages.put_nowait(await context.new_page())
+            yield pages
+        finally:
+            await browser.close()
 
-    if response.status_code == 200:
-        data = response.json()
-        if data:
 
-            postcode = data[0].get('address', {}).get('postcode')
-            return postcode
+async def fetch_result_page(page, page_number, retries=2):
+    """
+    The {"text", "link", "images"} of the listings on a results page,
+    retrying with a growing delay before giving up.
+    """
+    url = f"{RESULTS_URL}?page={page_number}"
+    for attempt in range(retries + 1):
+        try:
+            await page.goto(url)
+            # Wait for the container with all listings to load
+            await page.wait_for_selector(LISTINGS_CONTAINER)
+            listings = await page.eval_on_selector_all(LISTING_SELECTOR, EXTRACT_LISTINGS_JS)
+            break
+        except PlaywrightError:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(2 ** attempt)
+
+    for listing in listings:
+        listing['text'] = clean_listing_text(listing['text'])
+    return [listings]
+
+
+def fixture_handler(fixture_dir):
+    """
+    Route handler answering results page requests with
+    fixture_dir/page-<number>.html and blocking everything else.
+    """
+    async def handle(route):
+        request_url = urlparse(route.request.url)
+        if route.request.resource_type != "document" or \
+                not RESULTS_URL.endswith(request_url.path):
+            await route.abort()
+            return
+
+        page_number = parse_qs(request_url.query).get("page", ["1"])[0]
+        path = os.path.join(fixture_dir, f"page-{page_number}.html")
+        if os.path.exists(path):
+            await route.fulfill(path=path, content_type="text/html")
         else:
-            return "No results found."
-    else:
-        return f"Error: {response.status_code}"
+            # past the last saved page, like past the last page of the site
+            await route.fulfill(body=f'<div class="{LISTINGS_CONTAINER[1:].replace(".", " ")}"></div>',
+                                content_type="text/html")
+    return handle
 
 
-def date_to_epoch(date_str):
-    date_str = re.sub(r'(\d+)(st|nd|rd|th)', r'\1', date_str)
+def clean_listing_text(text):
+    return text.replace("\n", " ").replace("Featured", "").replace("Bills Included", "").strip()
 
-    date_obj = datetime.strptime(date_str, "%d %B %Y")
 
-    return int(date_obj.timestamp())
+def split_listing(listing, link, img_link):
+    """
+    A listing in the shape HouseRequests.ingest_listings takes. postal_code
+    and coordinates are filled in from road_area by the geocoder.
+    """
+    parsed = parse_listing(listing)
+    return {
+        'road_area': parsed.road,
+        'bedrooms': parsed.bedrooms,
+        'bathrooms': parsed.bathrooms,
+        'price_pp_pw': parsed.price_pp_pw,
+        'date_available_from': parsed.available_from,
+        'bills_inc': True,
+        'wifi_inc': True,
+        'washing_machine': True,
+        'url': link,
+        'listing_text': listing,
+        'images': img_link,
+    }
 
 
-def add_to_database(bedrooms_number, bathrooms_number, postcode, cost_pw, added, date_avai_from, link, img_links):
-    try:
-        house_requests = HouseRequests()
-        house_requests.add_house(bedrooms_number, bathrooms_number, postcode, cost_pw, added, date_avai_from, link, img_links)
-        house_requests.session.close()
-    except Exception as e:
-        print(e)
+def get_postcode(city, area):
+    """The postcode of an area of a city, or None if it couldn't be found."""
+    location = Geocoder().resolve(area, city)
+    return location and location['postcode']
 
 
+# Run from the repository root with: python -m app.housingApi.scraper
 if __name__ == "__main__":
+    create_house_database()
     # scrape_property_listings()
-    pass
+    # scrape_property_listings(fixture_dir=FIXTURE_DIR) to try it offline
+    HouseRequests().build_image_manifest()
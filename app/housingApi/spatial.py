@@ -0,0 +1,209 @@
+"""
+Grid index over house coordinates for "houses within N km" and "houses in
+this map viewport" queries.
+
+Houses store longitude in x_coord and latitude in y_coord. The index is
+built from the in-memory catalog snapshot and rebuilt whenever the catalog
+reloads. The map endpoint always uses it, so the first map request loads
+the catalog even when Config.HOUSE_CATALOG_ENABLED is off; that setting
+only decides whether property searches are answered from the catalog.
+"""
+import math
+import threading
+from array import array
+
+from app.housingApi.catalog import catalog
+
+EARTH_RADIUS_KM = 6371.0088
+
+# roughly 1.1km north-south and 0.7km east-west in Manchester
+DEFAULT_CELL_SIZE = 0.01
+
+
+class GridIndex:
+    """
+    Buckets the houses of a CatalogSnapshot into square cells of
+    cell_size degrees so a query only looks at houses in nearby cells.
+    """
+
+    def __init__(self, snapshot, cell_size=DEFAULT_CELL_SIZE):
+        self.snapshot = snapshot
+        self.cell_size = cell_size
+        self.cells = {}
+
+        lats = snapshot.y_coord
+        lons = snapshot.x_coord
+        for i in range(len(snapshot)):
+            lat, lon = lats[i], lons[i]
+            if math.isnan(lat) or math.isnan(lon):
+                continue
+            cell = self.__cell(lat, lon)
+            if cell not in self.cells:
+                self.cells[cell] = array('i')
+            self.cells[cell].append(i)
+
+    def within_bounds(self, min_lat, min_lon, max_lat, max_lon, limit=200):
+        """
+        Positions of the houses inside the box, at most `limit` of them.
+        Returns (positions, truncated).
+        """
+        lats = self.snapshot.y_coord
+        lons = self.snapshot.x_coord
+
+        positions = []
+        for i in self.__candidates(min_lat, min_lon, max_lat, max_lon):
+            if min_lat <= lats[i] <= max_lat and min_lon <= lons[i] <= max_lon:
+                positions.append(i)
+                if len(positions) > limit:
+                    return positions[:limit], True
+        return positions, False
+
+    def within_radius(self, lat, lon, radius_km, limit=200):
+        """
+        (distance in km, position) of the houses within radius_km of the
+        point, nearest first and at most `limit` of them.
+        """
+        lat_delta = math.degrees(radius_km / EARTH_RADIUS_KM)
+        # longitude degrees shrink towards the poles
+        lon_delta = lat_delta / max(math.cos(math.radians(lat)), 1e-6)
+
+        candidates = self.__candidates(lat - lat_delta, lon - lon_delta,
+                                       lat + lat_delta, lon + lon_delta)
+        distances = haversine_many(lat, lon, self.snapshot.y_coord,
+                                   self.snapshot.x_coord, candidates)
+
+        results = [(distance, i) for distance, i in zip(distances, candidates)
+                   if distance <= radius_km]
+        results.sort()
+        return results[:limit]
+
+    def __cell(self, lat, lon):
+        return (math.floor(lat / self.cell_size),
+                math.floor(lon / self.cell_size))
+
+    def __candidates(self, min_lat, min_lon, max_lat, max_lon):
+        min_row, min_column = self.__cell(min_lat, min_lon)
+        max_row, max_column = self.__cell(max_lat, max_lon)
+
+        # a huge box touches more cells than there are, so walk the cells
+        if (max_row - min_row + 1) * (max_column - min_column + 1) > len(self.cells):
+            cells = [positions for (row, column), positions in self.cells.items()
+                     if min_row <= row <= max_row and
+                     min_column <= column <= max_column]
+        else:
+            cells = [self.cells[(row, column)]
+                     for row in range(min_row, max_row + 1)
+                     for column in range(min_column, max_column + 1)
+                     if (row, column) in self.cells]
+
+        candidates = array('i')
+        for positions in cells:
+            candidates.extend(positions)
+        return candidates
+
+
+def haversine_many(lat, lon, lats, lons, positions):
+    """
+    Great-circle distances in km from (lat, lon) to each of the given
+    positions in the lats/lons columns. The trigonometry for the fixed
+    point is done once rather than per house.
+    """
+    lat1 = math.radians(lat)
+    lon1 = math.radians(lon)
+    cos_lat1 = math.cos(lat1)
+    radians = math.radians
+    sin = math.sin
+    cos = math.cos
+    asin = math.asin
+    sqrt = math.sqrt
+
+    distances = array('d')
+    for i in positions:
+        lat2 = radians(lats[i])
+        half_dlat = sin((lat2 - lat1) / 2)
+        half_dlon = sin((radians(lons[i]) - lon1) / 2)
+        a = half_dlat * half_dlat + cos_lat1 * cos(lat2) * half_dlon * half_dlon
+        distances.append(2 * EARTH_RADIUS_KM * asin(min(1.0, sqrt(a))))
+    return distances
+
+
+class HouseSpatialIndex:
+    """Keeps a GridIndex of the current catalog snapshot."""
+
+    def __init__(self, cell_size=DEFAULT_CELL_SIZE):
+        self.cell_size = cell_size
+        self._index = None
+        self._lock = threading.Lock()
+
+    def index(self):
+        snapshot = catalog.snapshot()
+        index = self._index
+        if index is None or index.snapshot is not snapshot:
+            with self._lock:
+                if self._index is None or self._index.snapshot is not snapshot:
+                    self._index = GridIndex(snapshot, self.cell_size)
+                index = self._index
+        return index
+
+    def houses_in_view(self, min_lat, min_lon, max_lat, max_lon, limit=200):
+        index = self.index()
+        positions, truncated = index.within_bounds(min_lat, min_lon,
+                                                   max_lat, max_lon, limit)
+        return {
+            'houses': [index.snapshot.house_dict(i) for i in positions],
+            'truncated': truncated
+        }
+
+    def houses_near(self, lat, lon, radius_km, limit=200):
+        index = self.index()
+        houses = []
+        for distance, i in index.within_radius(lat, lon, radius_km, limit):
+            house = index.snapshot.house_dict(i)
+            house['distance_km'] = round(distance, 3)
+            houses.append(house)
+        return {'houses': houses}
+
+
+spatial_index = HouseSpatialIndex()
+
+
+if __name__ == "__main__":
+    # Benchmark: radius and viewport queries over 50k houses around Manchester
+    import random
+    import statistics
+    import time
+    from types import SimpleNamespace
+
+    from app.housingApi.catalog import CatalogSnapshot
+
+    house_count = 50000
+    rng = random.Random(0)
+    houses = [SimpleNamespace(
+        id=i, price_pp_pw=rng.uniform(80, 300), bedrooms=rng.randint(1, 8),
+        bathrooms=rng.randint(1, 3), bills_inc=True, wifi_inc=True,
+        x_coord=-2.24 + rng.gauss(0, 0.04), y_coord=53.46 + rng.gauss(0, 0.03),
+        area="Manchester", postal_code="M14") for i in range(1, house_count + 1)]
+    snapshot = CatalogSnapshot(1, houses, {})
+
+    start = time.perf_counter()
+    index = GridIndex(snapshot)
+    print(f"indexed {house_count} houses into {len(index.cells)} cells in "
+          f"{(time.perf_counter() - start) * 1000:.1f} ms")
+
+    def median_ms(query, repeats=50):
+        timings = []
+        for _ in range(repeats):
+            start = time.perf_counter()
+            result = query()
+            timings.append(time.perf_counter() - start)
+        return statistics.median(timings) * 1000, result
+
+    university_of_manchester = (53.4668, -2.2339)
+    for radius_km in (0.5, 1, 2, 5):
+        ms, results = median_ms(lambda: index.within_radius(
+            *university_of_manchester, radius_km, limit=house_count))
+        print(f"radius {radius_km:>4} km: {len(results):>6} houses in {ms:.2f} ms")
+
+    ms, (positions, truncated) = median_ms(lambda: index.within_bounds(
+        53.455, -2.25, 53.475, -2.22, limit=500))
+    print(f"viewport: {len(positions)} houses (truncated={truncated}) in {ms:.2f} ms")
@@ -1,11 +1,20 @@
 import json
+import math
+import os
+import time
 from functools import wraps
 
-from flask import Blueprint, render_template, request, abort, session, redirect
-from app.housingApi.main import HouseRequests
+from flask import Blueprint, render_template, request, abort, session, redirect, \
+    url_for, current_app, send_from_directory, Response
+from app.housingApi.main import HouseRequests, image_manifest
+from app.housingApi.catalog import catalog
+from app.housingApi.spatial import spatial_index
+from app.housingApi.commute import requirement_filters
 from app.database.main import UserRequests
 from app.database.main import DatabaseRequests
-from app.housingApi.postcode_function import get_manchester_area
+from app.database.passwords import PasswordHasherBusy
+from app.database.chat_events import chat_events
+from app.database.message_queue import MessageQueueFull
 
 main = Blueprint('main', __name__)
 
@@ -30,8 +39,8 @@ def is_logged_in(f):
 @main.route('/')
 def home():
 
-    house_requests = HouseRequests()
-    houses = house_requests.get_all_houses(500)
+    # the first page of the property list, not every house
+    houses = HouseRequests().search_houses()['houses']
     return render_template('index.html',houses=houses)
 
 
@@ -43,8 +52,11 @@ def login():
         data = request.get_json()
         if len(data['username']) > 0 and len(data['password']) > 0:
             database_requests = DatabaseRequests()
-            session_id = database_requests.login(data['username'],
-                                              data['password'])
+            try:
+                session_id = database_requests.login(data['username'],
+                                                  data['password'])
+            except PasswordHasherBusy:
+                return json.dumps({'success': False, 'busy': True}), 503
             if session_id != "":
                 session['session_id'] = session_id
                 return json.dumps({'success': True})
@@ -63,7 +75,10 @@ def register():
         password = data['password']
 
         database_requests = DatabaseRequests()
-        session_id = database_requests.register(email, password)
+        try:
+            session_id = database_requests.register(email, password)
+        except PasswordHasherBusy:
+            return json.dumps({'success': False, 'busy': True}), 503
 
         if session_id != "":
             session['session_id'] = session_id
@@ -74,10 +89,77 @@ def register():
 
 
 
-@main.route('/logout')
+@main.route('/logout', methods=['GET', 'POST'])
 def logout():
-    # TODO: Logout
-    return json.dumps({})
+    session_id = session.pop('session_id', None)
+    if session_id is not None:
+        DatabaseRequests().logout(session_id)
+    if request.method == 'GET':
+        return redirect('/login')
+    return json.dumps({'success': True})
+
+
+# most missed messages sent at the start of one event stream
+MISSED_MESSAGES_LIMIT = 500
+
+
+@main.route('/messages/stream')
+@is_logged_in
+def message_stream(database_requests):
+    """
+    Server-Sent Events stream of new messages in the user's chats, each
+    with the message id as its event id. A reconnecting browser sends the
+    last id it saw in Last-Event-ID (the first connection passes it as
+    ?last_event_id=) and gets the messages it missed first.
+    """
+    last_event_id = request.headers.get('Last-Event-ID',
+                                        request.args.get('last_event_id'))
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    chat_ids = database_requests.get_chat_ids()
+    heartbeat = current_app.config['CHAT_STREAM_HEARTBEAT']
+    max_age = current_app.config['CHAT_STREAM_MAX_AGE']
+
+    def events():
+        nonlocal last_event_id
+        # subscribed once the response is being sent, so a body that is
+        # never read leaves no subscription behind; and before catching up,
+        # so nothing is missed in between
+        with chat_events.subscribe(chat_ids) as subscription:
+            yield "retry: 3000\n\n"
+            missed = []
+            if last_event_id is not None:
+                try:
+                    missed = database_requests.get_messages_since(last_event_id,
+                                                                  MISSED_MESSAGES_LIMIT)
+                finally:
+                    # the stream outlives the request and its session teardown
+                    database_requests.session.close()
+                if missed:
+                    last_event_id = missed[-1]['messageID']
+            for message in missed:
+                yield message_event(message)
+            # with more to catch up on, end after these and let the browser reconnect
+            if len(missed) >= MISSED_MESSAGES_LIMIT:
+                return
+
+            closes_at = time.monotonic() + max_age
+            while time.monotonic() < closes_at and not subscription.overflowed:
+                message = subscription.get(timeout=heartbeat)
+                if message is None:
+                    yield ": keep-alive\n\n"
+                elif last_event_id is None or message['messageID'] > last_event_id:
+                    yield message_event(message)
+
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+def message_event(message):
+    return f"id: {message['messageID']}\nevent: message\ndata: {json.dumps(message)}\n\n"
 
 
 @main.route('/messages', methods=['GET', 'POST'])
@@ -91,22 +173,49 @@ def messages(database_requests):
         print(users)
 
         return render_template('message_page.html', chats=chats,
-                               user_id=database_requests.user_id, users=users)
+                               user_id=database_requests.user_id, users=users,
+                               history_page_size=current_app.config['CHAT_HISTORY_PAGE_SIZE'])
     if request.method == 'POST':
         data = request.get_json()
         match data['type']:
             case 'get_chat_messages':
                 chat_id = data['chat_id']
-
-                messages = database_requests.get_chat_messages(chat_id)
+                # only messages newer than the ones the client has, or
+                # older ones for the history
+                after_message_id = data.get('after_message_id')
+                before_message_id = data.get('before_message_id')
+                max_messages = data.get('max', current_app.config['CHAT_HISTORY_PAGE_SIZE'])
+                if isinstance(max_messages, str) and max_messages.lstrip('-').isdigit():
+                    max_messages = int(max_messages)
+                if isinstance(max_messages, bool) or not isinstance(max_messages, int):
+                    abort(400)
+                max_messages = min(max(max_messages, 1),
+                                   current_app.config['CHAT_HISTORY_MAX_PAGE_SIZE'])
+
+                messages = database_requests.get_chat_messages(
+                    chat_id, max_messages, after_message_id=after_message_id,
+                    before_message_id=before_message_id)
                 if messages is not None:
                     return json.dumps({'success': True, 'messages': messages})
 
+            case 'sync_chats':
+                # {chat id: last message id the client has, or null}
+                chats, more = database_requests.sync_chats(
+                    data['chats'], page_size=current_app.config['CHAT_HISTORY_PAGE_SIZE'])
+                if chats is not None:
+                    return json.dumps({'success': True, 'chats': chats, 'more': more})
+
             case 'send_message':
                 chat_id = data['chat_id']
                 message = data['message']
 
-                success = database_requests.send_message(chat_id, message)
+                if current_app.config['MESSAGE_QUEUE_ENABLED']:
+                    try:
+                        success = database_requests.queue_message(chat_id, message)
+                    except MessageQueueFull:
+                        return json.dumps({'success': False, 'busy': True}), 503
+                else:
+                    success = database_requests.send_message(chat_id, message)
                 return json.dumps({'success': success})
 
             case 'create_chat':
@@ -209,6 +318,22 @@ def property_info(id):
         return add_remove_to_shortlist(id)
 
 
+@main.route('/house_images/<int:house_id>/<filename>')
+def house_image(house_id, filename):
+    content_hash = image_manifest.content_hash(house_id, filename)
+    if content_hash is None:
+        abort(404)
+
+    # urls carry the content hash, so the file behind one never changes
+    response = send_from_directory(
+        os.path.join(current_app.static_folder, 'images_for_houses', str(house_id)),
+        filename, etag=content_hash,
+        max_age=current_app.config['HOUSE_IMAGE_MAX_AGE'])
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
 @is_logged_in
 def add_remove_to_shortlist(database_requests, id):
     data = request.get_json()
@@ -223,9 +348,118 @@ def add_remove_to_shortlist(database_requests, id):
 
 @main.route('/property_list')
 def property_list():
-    house_requests = HouseRequests()
-    houses = house_requests.get_all_houses(500)
-    return render_template('property_list_page.html', houses=houses)
+    # the page loads its houses from /property_list/search as the user scrolls
+    return render_template('property_list_page.html')
+
+
+@main.route('/property_list/search')
+def property_list_search():
+    args = request.args
+
+    def flag(name):
+        value = args.get(name)
+        if value is None:
+            return None
+        return value.lower() in ('1', 'true', 'yes')
+
+    filters = {
+        'min_price': args.get('min_price', type=float),
+        'max_price': args.get('max_price', type=float),
+        'bedrooms': args.getlist('bedrooms'),
+        'bathrooms': args.getlist('bathrooms'),
+        'area': args.get('area'),
+        'bills_inc': flag('bills_inc'),
+        'wifi_inc': flag('wifi_inc'),
+    }
+    commute_filters = {
+        'max_minutes_to_uni': args.get('max_minutes_to_uni', type=int),
+        'university_id': args.get('university_id', type=int),
+        'max_minutes_to_city_centre': args.get('max_minutes_to_city_centre', type=int),
+        'transport': args.get('transport', 'walking'),
+    }
+
+    # fill in the filters from the logged in user's house requirements
+    if flag('match_requirements') and session.get('session_id') is not None:
+        database_requests = DatabaseRequests(session_id=session['session_id'])
+        if database_requests.is_logged_in():
+            house_requirements = database_requests.get_user_info()['houseRequirements']
+            if house_requirements:
+                try:
+                    requirements = requirement_filters(house_requirements,
+                                                       database_requests.get_university_id(),
+                                                       commute_filters['transport'])
+                except ValueError:
+                    abort(400)
+                for name, value in requirements.items():
+                    if name in commute_filters:
+                        commute_filters[name] = value
+                    else:
+                        filters[name] = value
+
+    query_text = args.get('q')
+
+    page = {
+        'sort': args.get('sort', 'relevance' if query_text else 'price-asc'),
+        'cursor': args.get('cursor'),
+        'limit': min(max(args.get('limit', 24, type=int), 1), 100),
+    }
+
+    # the in-memory catalog has no travel times or text index
+    needs_database = (commute_filters['max_minutes_to_uni'] is not None or
+                      commute_filters['max_minutes_to_city_centre'] is not None or
+                      query_text)
+
+    try:
+        if current_app.config['HOUSE_CATALOG_ENABLED'] and not needs_database:
+            results = catalog.search(**filters, **page)
+        else:
+            results = HouseRequests().search_houses(**filters, **commute_filters,
+                                                    query_text=query_text, **page)
+    except ValueError:
+        abort(400)
+
+    for house in results['houses']:
+        house['page_url'] = url_for('main.property_info', id=house['id'])
+
+    return json.dumps({'success': True, **results})
+
+
+@main.route('/property_map/houses')
+def property_map_houses():
+    """
+    Houses for the map. Either pass the viewport (min_lat, min_lon, max_lat,
+    max_lon), or a centre (lat, lon or university_id) and radius_km.
+    """
+    args = request.args
+    limit = min(max(args.get('limit', 200, type=int), 1), 1000)
+
+    if 'min_lat' in args:
+        try:
+            bounds = [float(args[name]) for name in ('min_lat', 'min_lon', 'max_lat', 'max_lon')]
+        except (KeyError, ValueError):
+            abort(400)
+        if not all(math.isfinite(value) for value in bounds):
+            abort(400)
+        results = spatial_index.houses_in_view(*bounds, limit)
+        return json.dumps({'success': True, **results})
+
+    university_id = args.get('university_id', type=int)
+    if university_id is not None:
+        location = UserRequests().get_university_location(university_id)
+        if location is None:
+            abort(404)
+        lat, lon = location
+    else:
+        lat = args.get('lat', type=float)
+        lon = args.get('lon', type=float)
+    radius_km = args.get('radius_km', 2, type=float)
+    if lat is None or lon is None or radius_km is None or \
+            not all(math.isfinite(value) for value in (lat, lon, radius_km)):
+        abort(400)
+    radius_km = min(max(radius_km, 0.1), current_app.config['MAP_MAX_RADIUS_KM'])
+
+    results = spatial_index.houses_near(lat, lon, radius_km, limit)
+    return json.dumps({'success': True, 'centre': [lat, lon], **results})
 
 
 @main.route('/search')
@@ -0,0 +1,109 @@
+"""
+SQLite engines for the users and houses databases: one writer connection
+and a pool of read-only connections per database, in WAL mode.
+
+In WAL mode readers don't block the writer or each other, but SQLite still
+allows one writer at a time. Writes in this process therefore share one
+connection, which starts its transactions with BEGIN IMMEDIATE so waiting
+for another process's write lock happens up front, within busy_timeout,
+instead of failing with "database is locked" half way through.
+
+RoutingSession sends a session's statements to the reader pool until it
+first writes (a flush, or an INSERT, UPDATE or DELETE statement); from then
+until the commit or rollback everything goes to the writer, so the session
+reads its own uncommitted changes.
+"""
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import Session as OrmSession, scoped_session, sessionmaker
+from sqlalchemy.sql.dml import UpdateBase
+
+from app.config import Config
+
+
+def chunks(values, size=500):
+    """Splits values into lists small enough for one IN (...) clause."""
+    values = list(values)
+    return [values[start:start + size] for start in range(0, len(values), size)]
+
+
+def _set_pragmas(dbapi_connection, read_only):
+    cursor = dbapi_connection.cursor()
+    if not read_only:
+        # kept in the database file, so readers find it set
+        cursor.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode only a power loss can lose the last commits
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute(f"PRAGMA busy_timeout={int(Config.SQLITE_BUSY_TIMEOUT * 1000)}")
+    # negative sizes are in KiB
+    cursor.execute(f"PRAGMA cache_size=-{Config.SQLITE_CACHE_SIZE_KIB}")
+    cursor.execute(f"PRAGMA mmap_size={Config.SQLITE_MMAP_SIZE}")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+
+def writer_engine(url):
+    """An engine with the one connection this process writes to url through."""
+    engine = create_engine(url, echo=False, pool_size=1, max_overflow=0,
+                           pool_timeout=Config.DATABASE_POOL_TIMEOUT)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        # let SQLAlchemy's begin event start transactions, not pysqlite
+        dbapi_connection.isolation_level = None
+        _set_pragmas(dbapi_connection, read_only=False)
+
+    @event.listens_for(engine, "begin")
+    def begin(connection):
+        connection.exec_driver_sql("BEGIN IMMEDIATE")
+
+    return engine
+
+
+def reader_engine(url):
+    """An engine with a pool of read-only connections to url."""
+    engine = create_engine(url, echo=False,
+                           pool_size=Config.DATABASE_POOL_SIZE,
+                           max_overflow=Config.DATABASE_MAX_OVERFLOW,
+                           pool_timeout=Config.DATABASE_POOL_TIMEOUT)
+
+    @event.listens_for(engine, "connect")
+    def connect(dbapi_connection, connection_record):
+        _set_pragmas(dbapi_connection, read_only=True)
+
+    return engine
+
+
+def sqlite_engines(url):
+    """
+    The (writer, reader) engines of a database. WAL mode is set by the
+    writer's first connection, which create_database and
+    create_house_database make when the app starts.
+    """
+    return writer_engine(url), reader_engine(url)
+
+
+class RoutingSession(OrmSession):
+    def __init__(self, writer=None, reader=None, **kwargs):
+        super().__init__(**kwargs)
+        self.writer = writer
+        self.reader = reader
+        self._writing = False
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self._writing or self._flushing or isinstance(clause, UpdateBase):
+            self._writing = True
+            return self.writer
+        return self.reader
+
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _stop_writing(session, transaction):
+    if transaction.parent is None:
+        session._writing = False
+
+
+def routing_session(writer, reader):
+    """A scoped_session reading from reader and writing through writer."""
+    return scoped_session(sessionmaker(class_=RoutingSession, writer=writer, reader=reader))
@@ -1,8 +1,8 @@
-from app import create_app
-from app.database.main import create_database
-
-app = create_app()
-
-if __name__ == '__main__':
-    create_database()
-    app.run(debug=True)
+from app import create_app
+
+# the databases are set up by create_app, run "flask --app run init-db"
+# once to add the seed users
+app = create_app()
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,62 @@
+"""
+The house list endpoints load their houses and cover images in a fixed
+number of queries, however many houses there are.
+"""
+import pytest
+from sqlalchemy import create_engine, event
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from app.housingApi.main import House, HouseRequests, Image, create_house_database
+
+SIZES = (1, 10, 50)
+
+
+def house_requests(house_count):
+    """HouseRequests on a new in-memory database of house_count houses, two images each."""
+    engine = create_engine("sqlite://", poolclass=StaticPool)
+    create_house_database(engine)
+    session = sessionmaker(bind=engine)()
+    session.add_all(House(id=i, bedrooms=2, bathrooms=1, postal_code="M14 5RQ",
+                          price_pp_pw=100 + i, x_coord=-2.22, y_coord=53.45,
+                          area="Fallowfield", url=f"https://example.com/{i}")
+                    for i in range(1, house_count + 1))
+    session.add_all(Image(house_id=i, url=f"https://example.com/{i}/{n}.jpg")
+                    for i in range(1, house_count + 1) for n in range(2))
+    session.commit()
+    return HouseRequests(session), engine
+
+
+def count_statements(engine, function):
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        result = function()
+    finally:
+        event.remove(engine, "before_cursor_execute", before_cursor_execute)
+    return len(statements), result
+
+
+LIST_CALLS = {
+    'get_all_houses': lambda requests, n: requests.get_all_houses(n),
+    'get_all_in_shortlist': lambda requests, n: requests.get_all_in_shortlist(list(range(1, n + 1))),
+    'search_houses': lambda requests, n: requests.search_houses(limit=n)['houses'],
+}
+
+
+@pytest.mark.parametrize("name", LIST_CALLS)
+def test_list_query_count_does_not_grow_with_houses(name):
+    counts = {}
+    for house_count in SIZES:
+        requests, engine = house_requests(house_count)
+        counts[house_count], houses = count_statements(
+            engine, lambda: LIST_CALLS[name](requests, house_count))
+        assert len(houses) == house_count
+        assert all(house['image'] == f"https://example.com/{house['id']}/0.jpg"
+                   for house in houses)
+        requests.session.close()
+    assert len(set(counts.values())) == 1, counts
@@ -0,0 +1,55 @@
+"""
+The listing parser against the saved corpus of listing texts, and
+date_to_epoch's handling of unusual dates.
+"""
+import calendar
+import datetime
+
+import pytest
+
+from app.housingApi.listing_parser import ListingParseError, ParsedListing, \
+    date_to_epoch, load_corpus, parse_listing
+
+CORPUS = load_corpus()
+
+
+def midnight_utc(year, month, day):
+    return calendar.timegm(datetime.date(year, month, day).timetuple())
+
+
+@pytest.mark.parametrize("case", CORPUS, ids=[case['text'][:60] for case in CORPUS])
+def test_corpus(case):
+    if case['expected'] is None:
+        with pytest.raises(ListingParseError):
+            parse_listing(case['text'])
+        return
+    parsed = parse_listing(case['text'])
+    assert {name: getattr(parsed, name) for name in ParsedListing.__slots__} == case['expected']
+
+
+@pytest.mark.parametrize("date_str, expected", [
+    ("1st July 2025", midnight_utc(2025, 7, 1)),
+    ("2nd Sept 2025", midnight_utc(2025, 9, 2)),
+    ("3rd sep 2025", midnight_utc(2025, 9, 3)),
+    ("22 DECEMBER 2024", midnight_utc(2024, 12, 22)),
+    ("  31st January 2026  ", midnight_utc(2026, 1, 31)),
+    ("29th February 2024", midnight_utc(2024, 2, 29)),
+    ("1st January 1970", 0),
+])
+def test_date_to_epoch(date_str, expected):
+    assert date_to_epoch(date_str) == expected
+
+
+@pytest.mark.parametrize("date_str", [
+    "31st February 2025",
+    "29th February 2025",
+    "0th July 2025",
+    "32nd July 2025",
+    "1st Julember 2025",
+    "July 1st 2025",
+    "1st July",
+    "",
+])
+def test_date_to_epoch_rejects(date_str):
+    with pytest.raises(ListingParseError):
+        date_to_epoch(date_str)